@@ -1,8 +1,29 @@
+import os
+import time
+import uuid
 import streamlit as st
-from transformers import pipeline
-from planner import create_weekly_plan  
-from knowledge_base import load_vector_store
+from planner import create_weekly_plan, is_plan_request
+from chat import MAX_NEW_TOKENS, answer_question, retrieve_prompt
+from generation_server import MAX_BATCH_SIZE
+from conversation_memory import ConversationMemory, approx_tokens, tokenizer_counter
+from job_queue import DONE, FAILED, FINISHED
+from llm_connector import get_llm, stream_generate
+from knowledge_base import EMBEDDING_MODEL
+from resources import (
+    MODEL_NAME, get_causal_lm, get_embeddings, get_job_manager, get_plan_store, get_response_cache, get_vector_store,
+)
 from langdetect import detect
+from telemetry import span
+
+# با مقدار 1، درخواست‌های همه کاربران در دسته‌های مشترک تولید می‌شوند (توان عملیاتی بیشتر به جای پخش زنده توکن‌ها)
+BATCHED_GENERATION = os.environ.get("ADVISOR_BATCHED_GENERATION", "0") == "1"
+# حداکثر زمان (ثانیه) برای تولید یک پاسخ یا برنامه
+JOB_TIMEOUT = int(os.environ.get("ADVISOR_JOB_TIMEOUT", "300"))
+# تعداد تولیدهای هم‌زمان در هر پروسه؛ پیش‌فرض دو برابر اندازه دسته است تا دسته بعدی هنگام تولید دسته فعلی پر شود
+JOB_WORKERS = int(os.environ.get("ADVISOR_JOB_WORKERS", "0")) or 2 * MAX_BATCH_SIZE
+POLL_INTERVAL = 0.3
+# فقط آخرین پیام‌ها نمایش داده می‌شوند؛ بقیه گفتگو در حافظه خلاصه‌شده می‌ماند
+MAX_DISPLAYED_MESSAGES = 40
 
 st.set_page_config(page_title="Smart Academic Advisor", layout="wide")
 st.title("Smart Academic Advisor")
@@ -22,80 +43,138 @@ st.markdown("""
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-if "weekly_plan" not in st.session_state:
-    st.session_state.weekly_plan = {}
+# برنامه‌های هفتگی در پایگاه داده ذخیره می‌شوند و با شماره دانشجویی در جلسه‌های بعد هم در دسترس‌اند
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+session_id = st.session_state.session_id
+student_id = st.sidebar.text_input("شماره دانشجویی").strip() or f"session-{session_id[:8]}"
+plan_store = get_plan_store()
 
-# تعریف مدل با تنظیمات مناسب
+# مدل و پایگاه دانش یک بار در هر پروسه بارگذاری می‌شوند و بین اجراهای مجدد مشترک‌اند
 try:
-    llm = pipeline(
-        "text-generation",
-        model="HooshvareLab/gpt2-fa",
-        tokenizer="HooshvareLab/gpt2-fa",
-        max_length=512,
-        pad_token_id=5
-    )
+    llm = get_llm(batched=BATCHED_GENERATION)
 except Exception as e:
     st.error(f"خطا در بارگذاری مدل: {str(e)}")
     llm = None
 
-vector_store = load_vector_store()
+vector_store = get_vector_store()
+# پاسخ سؤال‌های تکراری (از نظر معنایی) بدون جستجو و تولید دوباره برگردانده می‌شود
+response_cache = get_response_cache()
+
+# حافظه گفتگو با بودجه توکن: چند نوبت آخر کامل و نوبت‌های قدیمی‌تر به صورت خلاصه
+if "memory" not in st.session_state:
+    st.session_state.memory = ConversationMemory(
+        count_tokens=tokenizer_counter(get_causal_lm(MODEL_NAME)[0]) if llm is not None else approx_tokens,
+        embeddings=get_embeddings(EMBEDDING_MODEL),
+    )
+memory = st.session_state.memory
+
+
+def add_message(role, content):
+    st.session_state.messages.append({"role": role, "content": content})
+    del st.session_state.messages[:-MAX_DISPLAYED_MESSAGES]
+    memory.add(role, content)
+
+# تولید پاسخ در پس‌زمینه انجام می‌شود تا اجرای مجدد صفحه منتظر مدل نماند
+jobs = get_job_manager(max_workers=JOB_WORKERS)
+poll = False
+
+
+def chat_job(job, question, history):
+    if BATCHED_GENERATION:
+        return answer_question(question, llm, vector_store, history=history, response_cache=response_cache)
+    cached = response_cache.lookup(question, vector_store.corpus_version)
+    if cached is not None:
+        return cached
+
+    prompt = retrieve_prompt(question, vector_store, history=history)
+    # متن تولیدشده تا این لحظه برای نمایش زنده در صفحه منتشر می‌شود
+    response_text = ""
+    for piece in stream_generate(prompt, max_new_tokens=MAX_NEW_TOKENS, stop=job.should_stop):
+        response_text += piece
+        job.update(response_text)
+    response_text = response_text.strip()
+    if response_text and not job.should_stop():
+        response_cache.add(question, response_text, vector_store.corpus_version)
+    return response_text
+
+
+def plan_job(job, request, student_id):
+    return create_weekly_plan(request, llm, student_id=student_id, store=plan_store, stop=job.should_stop)
+
+
+def job_output(job):
+    """Result of a finished job, or the partial text / an error message if it did not complete."""
+    if job.status == DONE:
+        return job.result()
+    if job.status == FAILED:
+        try:
+            job.result()
+        except Exception as e:
+            st.error(f"خطا در تولید پاسخ: {str(e)}")
+        return None
+    if job.partial:
+        return job.partial.strip()
+    return None
+
 
 # نمایش پیام‌های قبلی
 for msg in st.session_state.messages:
     with st.chat_message(msg["role"]):
         st.markdown(f"<div class='rtl'>{msg['content']}</div>", unsafe_allow_html=True)
 
-user_input = st.chat_input("سؤالت را بپرس...")
+# پاسخ در حال تولید
+chat_job_id = st.session_state.get("chat_job")
+if chat_job_id is not None:
+    job = jobs.get(chat_job_id)
+    if job is None or job.status in FINISHED:
+        response_text = job_output(job) if job is not None else None
+        if job is not None and job.kind == "weekly_plan" and job.status == DONE:
+            response_text, _ = response_text
+        if not response_text:
+            response_text = "متأسفانه در تولید پاسخ مشکلی پیش آمد. لطفاً دوباره تلاش کنید."
+        add_message("assistant", response_text)
+        st.session_state.chat_job = None
+        st.rerun()
+
+    with st.chat_message("assistant"):
+        if job.partial:
+            st.markdown(f"<div class='rtl'>{job.partial}▌</div>", unsafe_allow_html=True)
+        else:
+            st.markdown("<div class='rtl'>در حال تولید پاسخ...</div>", unsafe_allow_html=True)
+        if st.button("توقف", key="cancel_chat_job"):
+            jobs.cancel(chat_job_id)
+    poll = True
+
+user_input = st.chat_input("سؤالت را بپرس...", disabled=chat_job_id is not None)
 
 if user_input:
-    with st.chat_message("user"):
-        st.markdown(f"<div class='rtl'>{user_input}</div>", unsafe_allow_html=True)
-    st.session_state.messages.append({"role": "user", "content": user_input})
+    # تاریخچه مرتبط پیش از افزودن سؤال جدید به حافظه گرفته می‌شود
+    history = tuple(memory.segments(user_input))
+    add_message("user", user_input)
     
     try:
-        is_farsi = detect(user_input) == "fa"
+        with span("language_detection"):
+            is_farsi = detect(user_input) == "fa"
     except:
         is_farsi = True
     
-    with st.spinner("در حال تولید پاسخ..."):
-        try:
-            if llm is None:
-                raise ValueError("مدل LLM بارگذاری نشده است. لطفاً بررسی کنید.")
-
-            if "برنامه هفتگی" in user_input.lower() or "برنامه‌ریزی" in user_input.lower():
-                response_text, week_num = create_weekly_plan(user_input, llm)
-                st.session_state.weekly_plan[week_num] = response_text
-            else:
-                docs = vector_store.similarity_search(user_input, k=3)
-                context = "\n".join([doc.page_content for doc in docs])
-                prompt = f"سؤال: {user_input}\n\nاطلاعات مرتبط:\n{context}\n\nپاسخ مفصل:"
-                
-                response_full = llm(
-                    prompt,
-                    max_new_tokens=200,
-                    do_sample=True
-                )
-                
-                print(f"نوع response_full: {type(response_full)}")
-                print(f"مقدار response_full: {response_full}")
-                
-                if isinstance(response_full, list) and len(response_full) > 0 and isinstance(response_full[0], dict):
-                    response_full = response_full[0].get("generated_text", "")
-                else:
-                    response_full = str(response_full)
-                
-                if len(response_full) > len(prompt):
-                    response_text = response_full[len(prompt):].strip()
-                else:
-                    response_text = response_full.strip()
-                
-        except Exception as e:
-            st.error(f"خطا در تولید پاسخ: {str(e)}")
-            response_text = "متأسفانه در تولید پاسخ مشکلی پیش آمد. لطفاً دوباره تلاش کنید."
-    
-    st.session_state.messages.append({"role": "assistant", "content": response_text})
-    with st.chat_message("assistant"):
-        st.markdown(f"<div class='rtl'>{response_text}</div>", unsafe_allow_html=True)
+    if llm is None:
+        add_message("assistant", "مدل LLM بارگذاری نشده است. لطفاً بررسی کنید.")
+    elif is_plan_request(user_input):
+        stored = plan_store.get(student_id, user_input)
+        if stored is not None:
+            add_message("assistant", stored["plan"])
+        else:
+            st.session_state.chat_job = jobs.submit(
+                "weekly_plan", plan_job, user_input, student_id,
+                key=(session_id, user_input, student_id), timeout=JOB_TIMEOUT,
+            )
+    else:
+        # کلید کار شامل شناسه جلسه است تا توقف در یک جلسه پاسخ جلسه دیگری را متوقف نکند
+        st.session_state.chat_job = jobs.submit(
+            "chat", chat_job, user_input, history, key=(session_id, user_input, history), timeout=JOB_TIMEOUT
+        )
     
     st.rerun()
 
@@ -104,19 +183,44 @@ tab1, tab2 = st.tabs(["weekly_plan", "conversation"])
 with tab1:
     st.header("درخواست برنامه هفتگی")
     plan_input = st.text_input("درخواست خود برای برنامه هفتگی را وارد کنید (برای مثال: 'یک برنامه هفتگی برای مطالعه ریاضی می‌خواهم.')", key="weekly_plan_input")
-    if plan_input:
-        with st.spinner("در حال ایجاد برنامه هفتگی..."):
-            if llm is None:
-                st.error("مدل LLM بارگذاری نشده است. لطفاً بررسی کنید.")
-            else:
-                response, week_num = create_weekly_plan(plan_input, llm)
-                st.session_state.weekly_plan[week_num] = response
+    stored = plan_store.get(student_id, plan_input) if plan_input else None
+    if stored is not None:
+        # برنامه‌ای که قبلاً برای همین درخواست ساخته شده بدون تولید دوباره نمایش داده می‌شود
+        st.markdown(f'<div class="rtl">{stored["plan"]}</div>', unsafe_allow_html=True)
+    elif plan_input:
+        if llm is None:
+            st.error("مدل LLM بارگذاری نشده است. لطفاً بررسی کنید.")
+        else:
+            # هر درخواست فقط یک بار ارسال می‌شود؛ اجرای مجدد صفحه همان کار را دنبال می‌کند
+            if (plan_input, student_id) != st.session_state.get("plan_request"):
+                st.session_state.plan_request = (plan_input, student_id)
+                st.session_state.plan_job = jobs.submit(
+                    "weekly_plan", plan_job, plan_input, student_id,
+                    key=(session_id, plan_input, student_id), timeout=JOB_TIMEOUT,
+                )
+            job = jobs.get(st.session_state.plan_job)
+            if job is None:
+                st.session_state.plan_request = None
+            elif job.status == DONE:
+                response, _ = job.result()
                 st.markdown(f'<div class="rtl">{response}</div>', unsafe_allow_html=True)
+            elif job.status in FINISHED:
+                job_output(job)
+                st.warning("ایجاد برنامه هفتگی متوقف شد.")
+            else:
+                st.info("در حال ایجاد برنامه هفتگی...")
+                if st.button("توقف", key="cancel_plan_job"):
+                    jobs.cancel(job.id)
+                poll = True
 
     st.header("تاریخچه گفتگو")
-    if st.session_state.weekly_plan:
-        selected = st.selectbox("هفته مورد نظر را انتخاب کنید:", list(st.session_state.weekly_plan.keys()))
-        st.markdown(f'<div class="rtl">{st.session_state.weekly_plan[selected]}</div>', unsafe_allow_html=True)
+    plans = plan_store.weeks(student_id)
+    if plans:
+        selected = st.selectbox(
+            "هفته مورد نظر را انتخاب کنید:", plans,
+            format_func=lambda row: f"هفته {row['week']} - {row['topic']}",
+        )
+        st.markdown(f'<div class="rtl">{selected["plan"]}</div>', unsafe_allow_html=True)
     else:
         st.info("هنوز برنامه‌ای تولید نشده است.")
 
@@ -125,6 +229,12 @@ with tab2:
     if st.session_state.messages:
         if st.button("پاک کردن تاریخچه"):
             st.session_state.messages = []
+            memory.clear()
             st.rerun()
     else:
-        st.info("هنوز گفتگویی انجام نشده است.")
\ No newline at end of file
+        st.info("هنوز گفتگویی انجام نشده است.")
+
+# تا پایان کارهای در حال اجرا، صفحه به‌صورت دوره‌ای به‌روزرسانی می‌شود
+if poll:
+    time.sleep(POLL_INTERVAL)
+    st.rerun()
@@ -0,0 +1,189 @@
+"""
+Headless batch advising: answer a file of questions and weekly-plan requests without the UI.
+
+    python batch_advise.py questions.jsonl answers.jsonl --workers 8
+    python batch_advise.py cohort.csv plans.jsonl --kind weekly_plan
+
+Input is JSONL or CSV with a "question" column (or "text"/"prompt") and optional
+"id", "kind" ("chat" or "weekly_plan"; by default detected like the chat UI
+does) and "student_id" (weekly plans are stored per student in the plan store,
+and plans a student already has are returned without generating; a row without a
+student_id gets its own id "batch:<input path>:<row id>", which cannot collide with
+a real student number). Questions are read in batches, retrieval for a batch is
+done with one embedding call, and generation runs on --workers threads feeding the
+shared micro-batching GenerationServer, so concurrent prompts share model.generate
+calls.
+Each result is appended to the output JSONL as soon as it is ready; rows already
+in the output are skipped on restart.
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+from tqdm import tqdm
+
+from chat import MAX_NEW_TOKENS, RAG_TOP_K, extract_generated_text, retrieve_prompts
+from file_processor import iter_batches
+from llm_connector import get_llm
+from planner import create_weekly_plan, is_plan_request
+from resources import get_vector_store
+
+QUESTION_FIELDS = ("question", "text", "prompt")
+BATCH_SIZE = 32
+
+
+def read_requests(path, kind=None):
+    """Yield {"id", "kind", "question", "student_id", ...} rows from a JSONL or CSV file."""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if os.path.splitext(path)[1].lower() == ".csv":
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for index, row in enumerate(rows):
+            question = next((row[field] for field in QUESTION_FIELDS if row.get(field)), None)
+            if not question:
+                print(f"Skipping row {index}: no question field")
+                continue
+            row_id = str(row.get("id") or index)
+            yield {
+                **row,
+                "id": row_id,
+                "kind": kind or row.get("kind") or ("weekly_plan" if is_plan_request(question) else "chat"),
+                "question": question,
+                "student_id": str(row.get("student_id") or f"batch:{os.path.abspath(path)}:{row_id}"),
+            }
+
+
+def load_done(output_path):
+    """Ids already answered in the output file (failed rows are retried)."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if not row.get("error"):
+                done.add(row["id"])
+    return done
+
+
+def _answer(llm, request, segments, max_new_tokens):
+    started = time.perf_counter()
+    row = {"id": request["id"], "kind": request["kind"], "question": request["question"]}
+    try:
+        if request["kind"] == "weekly_plan":
+            answer, week = create_weekly_plan(request["question"], llm, student_id=request["student_id"])
+            # the planner reports failures as (message, "error") and an empty plan as (message, None);
+            # such rows are retried on resume
+            if week in ("error", None):
+                row["error"] = answer
+            else:
+                row["answer"], row["week"] = answer, week
+        else:
+            output = llm(segments, max_new_tokens=max_new_tokens)
+            row["answer"] = extract_generated_text(output, "".join(segments))
+    except Exception as e:
+        row["error"] = str(e)
+    row["latency_s"] = time.perf_counter() - started
+    return row
+
+
+def run_batch(requests, output_path, vector_store, llm, workers=4, batch_size=BATCH_SIZE, k=RAG_TOP_K,
+              max_new_tokens=MAX_NEW_TOKENS, total=None):
+    """
+    Answer requests and append one JSON line per result to output_path.
+
+    At most one batch is waiting for generation while the next one is retrieved, so
+    memory stays bounded for any input size. Returns throughput and latency stats.
+    """
+    started = time.perf_counter()
+    latencies = []
+    errors = 0
+    pending = set()
+
+    def drain(limit):
+        nonlocal errors
+        while len(pending) > limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                row = future.result()
+                errors += "error" in row
+                latencies.append(row["latency_s"])
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                f.flush()
+                progress.update(1)
+
+    with open(output_path, "a", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=total, desc="Advising", unit="q") as progress:
+        for batch in iter_batches(requests, batch_size):
+            chats = [request for request in batch if request["kind"] == "chat"]
+            prompts = dict(zip(
+                (request["id"] for request in chats),
+                retrieve_prompts([request["question"] for request in chats], vector_store, k) if chats else [],
+            ))
+            for request in batch:
+                pending.add(executor.submit(_answer, llm, request, prompts.get(request["id"]), max_new_tokens))
+            drain(batch_size)
+        drain(0)
+
+    elapsed = time.perf_counter() - started
+    return {
+        "answered": len(latencies),
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_latency_s": float(np.percentile(latencies, 50)) if latencies else 0.0,
+        "p95_latency_s": float(np.percentile(latencies, 95)) if latencies else 0.0,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Answer a file of advising questions without the UI")
+    parser.add_argument("input", help="JSONL or CSV file with a question column")
+    parser.add_argument("output", help="JSONL file results are appended to; answered ids are skipped on restart")
+    parser.add_argument("--kind", choices=("chat", "weekly_plan"), help="Treat every row as this kind")
+    parser.add_argument("--workers", type=int, default=8, help="Requests generated concurrently")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Questions retrieved per batch")
+    parser.add_argument("--top-k", type=int, default=RAG_TOP_K, help="Chunks retrieved per question")
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--docs", help="Document directory to (incrementally) index before answering")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    done = load_done(args.output)
+    requests = [request for request in read_requests(args.input, args.kind) if request["id"] not in done]
+    if done:
+        print(f"Resuming: {len(done)} rows already in {args.output}")
+    if not requests:
+        print("Nothing to do.")
+        return
+
+    print("Loading model and knowledge base...")
+    vector_store = get_vector_store(args.docs)
+    if vector_store is None:
+        print("Failed to load the knowledge base. Exiting.")
+        return
+    # the generation server batches the workers' prompts into shared generate calls
+    llm = get_llm(batched=True)
+
+    stats = run_batch(requests, args.output, vector_store, llm, args.workers, args.batch_size, args.top_k,
+                      args.max_new_tokens, total=len(requests))
+
+    print("\n===== Batch Results =====")
+    for key, value in stats.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""
+Latency/throughput benchmark for the RAG pipeline.
+
+Builds synthetic DOCX corpora of several sizes and times each stage separately:
+document loading, vector-store build, weekly-plan generation, stored-plan lookup
+and the chat path split into hybrid retrieval, context packing with prompt
+assembly, generation and decoding. By default a deterministic stub LLM,
+hash-based stub embeddings and approximate token counts are used so the suite
+runs offline and results are comparable between commits; --real-models uses the
+HuggingFace models instead.
+
+    python benchmark.py --corpus-sizes 10 100 --output bench.json
+    python benchmark.py --baseline bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+import resources
+
+WORDS = ["درس", "ریاضی", "فیزیک", "برنامه", "هفتگی", "امتحان", "پیش‌نیاز", "واحد", "ترم", "استاد",
+         "course", "exam", "credit", "syllabus", "deadline"]
+QUESTIONS = ["پیش‌نیاز درس ریاضی ۲ چیست؟", "زمان امتحان فیزیک کی است؟", "چند واحد باید بگیرم؟",
+             "What is the deadline for course registration?"]
+# synthetic --compare-indexes corpus: 10 chunks per file, 12000 chunks in total, above
+# vector_index.IVFPQ_MIN_VECTORS so ivfpq is measured rather than its flat fallback
+INDEX_CORPUS_FILES = 1200
+
+
+class StubLLM:
+    """Deterministic stand-in for the text-generation model with the same call contract."""
+
+    def __init__(self, tokens_per_second=None):
+        self.tokens_per_second = tokens_per_second
+
+    def __call__(self, prompt, max_new_tokens=200, **kwargs):
+        if not isinstance(prompt, str):
+            prompt = "".join(prompt)
+        words = [WORDS[(len(prompt) + i) % len(WORDS)] for i in range(max_new_tokens)]
+        if self.tokens_per_second:
+            time.sleep(max_new_tokens / self.tokens_per_second)
+        return prompt + " " + " ".join(words)
+
+
+def use_stub_embeddings(size=384):
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+    from embedding_cache import CachedEmbeddings
+
+    resources.evict("embeddings")
+    resources.register_factory(
+        "embeddings", lambda name, **config: CachedEmbeddings(DeterministicFakeEmbedding(size=size))
+    )
+
+
+def write_docx(path, paragraphs):
+    """Write a minimal DOCX file containing the given paragraphs."""
+    body = "".join(f"<w:p><w:r><w:t>{p}</w:t></w:r></w:p>" for p in paragraphs)
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>'
+        )
+        z.writestr(
+            "word/document.xml",
+            '<?xml version="1.0"?><w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{body}</w:body></w:document>"
+        )
+
+
+def make_corpus(directory, num_files, paragraphs_per_file=20, seed=0):
+    rng = np.random.default_rng(seed)
+    for i in range(num_files):
+        paragraphs = [" ".join(rng.choice(WORDS, size=60)) + f" CS{100 + i}" for _ in range(paragraphs_per_file)]
+        write_docx(os.path.join(directory, f"course_{i:05d}.docx"), paragraphs)
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is the lifetime peak (KiB on Linux, bytes on macOS)
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if platform.system() == "Darwin" else usage * 1024
+
+
+class PeakRSS:
+    """Sample the process RSS in a background thread and keep the maximum."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+
+def summarize(latencies, peak_rss, items=None):
+    latencies = np.asarray(latencies)
+    total = latencies.sum()
+    return {
+        "runs": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "throughput_per_s": float((items or len(latencies)) / total) if total > 0 else None,
+        "peak_rss_mb": peak_rss / (1024 * 1024),
+    }
+
+
+def time_stage(fn, repeats, items=None):
+    """Run fn `repeats` times and summarize latency, throughput and peak RSS."""
+    latencies = []
+    result = None
+    with PeakRSS() as rss:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            result = fn()
+            latencies.append(time.perf_counter() - started)
+    return summarize(latencies, rss.peak, items), result
+
+
+def bench_chat(llm, vector_store, repeats, max_new_tokens, count_tokens=None):
+    """
+    Time the app's chat path stage by stage: hybrid retrieval, context packing and prompt
+    assembly, generation and decoding. count_tokens is passed to chat.pack_docs.
+    """
+    from chat import build_rag_segments, extract_generated_text, pack_docs, retrieve_docs
+
+    stages = {"retrieval": [], "prompt": [], "generation": [], "decoding": [], "end_to_end": []}
+    with PeakRSS() as rss:
+        for i in range(repeats):
+            question = QUESTIONS[i % len(QUESTIONS)]
+            t0 = time.perf_counter()
+            docs = retrieve_docs(question, vector_store)
+            t1 = time.perf_counter()
+            context = pack_docs(question, docs, vector_store, count_tokens=count_tokens)
+            segments = build_rag_segments(question, docs, context=context)
+            t2 = time.perf_counter()
+            output = llm(segments, max_new_tokens=max_new_tokens)
+            t3 = time.perf_counter()
+            extract_generated_text(output, "".join(segments))
+            t4 = time.perf_counter()
+            for name, value in (("retrieval", t1 - t0), ("prompt", t2 - t1), ("generation", t3 - t2),
+                                ("decoding", t4 - t3), ("end_to_end", t4 - t0)):
+                stages[name].append(value)
+    return {f"chat_{name}": summarize(values, rss.peak) for name, values in stages.items()}
+
+
+def run(corpus_sizes, repeats, llm, max_new_tokens, workers, count_tokens=None):
+    from file_processor import load_documents
+    from knowledge_base import load_vector_store
+    from plan_store import PlanStore
+    from planner import create_weekly_plan
+
+    report = {}
+    for size in corpus_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            corpus_dir = os.path.join(tmp, "docs")
+            os.makedirs(corpus_dir)
+            make_corpus(corpus_dir, size)
+
+            stages = {}
+            stages["load_documents"], chunks = time_stage(lambda: load_documents(corpus_dir), repeats)
+            stages["load_documents"]["chunks"] = len(chunks)
+
+            def build():
+                resources.evict("embeddings")
+                index_path = tempfile.mkdtemp(dir=tmp)
+                return load_vector_store(corpus_dir, index_path=index_path, max_workers=workers)
+
+            stages["load_vector_store"], vector_store = time_stage(build, repeats, items=len(chunks) * repeats)
+            # a temporary store and a new student per repeat, so every call generates; the
+            # stored-plan lookup is measured separately
+            plan_store = PlanStore(os.path.join(tmp, "plans.sqlite3"))
+            students = iter(range(repeats))
+            plan_request = "یک برنامه هفتگی برای مطالعه ریاضی"
+            stages["create_weekly_plan"], _ = time_stage(
+                lambda: create_weekly_plan(plan_request, llm, student_id=f"bench-{next(students)}", store=plan_store),
+                repeats,
+            )
+            stages["weekly_plan_lookup"], _ = time_stage(
+                lambda: create_weekly_plan(plan_request, llm, student_id="bench-0", store=plan_store), repeats
+            )
+            stages.update(bench_chat(llm, vector_store, repeats, max_new_tokens, count_tokens))
+            report[str(size)] = stages
+            print(f"corpus={size} files, {len(chunks)} chunks")
+            for name, stats in stages.items():
+                print(f"  {name:22s} p50={stats['p50_ms']:9.2f}ms p95={stats['p95_ms']:9.2f}ms "
+                      f"p99={stats['p99_ms']:9.2f}ms rss={stats['peak_rss_mb']:8.1f}MB")
+    return report
+
+
+def compare_backends(backends, prompts=QUESTIONS, max_new_tokens=50, num_threads=None, loader=None):
+    """
+    Greedy-decode the same prompts on every backend and compare against eager.
+
+    Reports tokens/sec, the fraction of generated tokens identical to the eager
+    output, top-1 agreement and max absolute difference of the next-token logits.
+    """
+    from inference_backends import load_causal_lm
+
+    loader = loader or (lambda backend: load_causal_lm(resources.MODEL_NAME, backend, num_threads))
+    results = {}
+    reference = None
+    for backend in ["eager"] + [b for b in backends if b != "eager"]:
+        tokenizer, model = loader(backend)
+        encoded = [tokenizer(prompt, return_tensors="pt") for prompt in prompts]
+        generate_kwargs = {"max_new_tokens": max_new_tokens, "do_sample": False,
+                           "pad_token_id": tokenizer.pad_token_id or tokenizer.eos_token_id}
+
+        import torch
+        with torch.no_grad():
+            # warm-up, so one-time compilation/export is not counted as generation time
+            model.generate(**encoded[0], **generate_kwargs)
+            logits, outputs = [], []
+            started = time.perf_counter()
+            new_tokens = 0
+            for inputs in encoded:
+                output = model.generate(**inputs, **generate_kwargs)[0, inputs["input_ids"].shape[1]:]
+                outputs.append(output)
+                new_tokens += len(output)
+            elapsed = time.perf_counter() - started
+            for inputs in encoded:
+                logits.append(model(**inputs).logits[0, -1].float())
+
+        stats = {"tokens_per_s": new_tokens / elapsed, "seconds": elapsed}
+        if reference is None:
+            reference = (outputs, logits)
+        else:
+            ref_outputs, ref_logits = reference
+            matched = sum(int((a[:len(b)] == b[:len(a)]).sum()) for a, b in zip(outputs, ref_outputs))
+            total = sum(max(len(a), len(b)) for a, b in zip(outputs, ref_outputs))
+            stats["token_match"] = matched / total if total else 1.0
+            stats["top1_agreement"] = sum(
+                int(a.argmax() == b.argmax()) for a, b in zip(logits, ref_logits)
+            ) / len(logits)
+            stats["max_abs_logit_diff"] = max(float((a - b).abs().max()) for a, b in zip(logits, ref_logits))
+            stats["speedup"] = stats["tokens_per_s"] / results["eager"]["tokens_per_s"]
+        results[backend] = stats
+        print(f"  {backend:8s} " + " ".join(f"{k}={v:.3f}" for k, v in stats.items()))
+        del model
+    return results
+
+
+def compare_indexes(index_types, corpus_dir=None, queries=None, k=10, num_files=INDEX_CORPUS_FILES):
+    """Recall@k / latency of compressed index types against flat search on a real or synthetic corpus."""
+    from file_processor import iter_document_chunks
+    from knowledge_base import EMBEDDING_MODEL
+    from vector_index import recall_report
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if corpus_dir is None:
+            corpus_dir = tmp
+            make_corpus(corpus_dir, num_files)
+        texts = [doc.page_content for doc in iter_document_chunks(corpus_dir)]
+
+    if not queries:
+        # without real queries, use the opening words of a sample of chunks
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(texts), size=min(100, len(texts)), replace=False)
+        queries = [" ".join(texts[i].split()[:12]) for i in sample]
+
+    report = recall_report(texts, resources.get_embeddings(EMBEDDING_MODEL), queries, ["flat"] + list(index_types), k)
+    print(f"{len(texts)} chunks, {len(queries)} queries, k={k}")
+    for index_type, stats in report.items():
+        if "skipped" in stats:
+            print(f"  {index_type:6s} skipped: {stats['skipped']}")
+            continue
+        print(f"  {index_type:6s} " + " ".join(f"{key}={value:.3f}" for key, value in stats.items()))
+    return report
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Print the p50 ratio of every stage against a saved baseline (>1 means slower)."""
+    print(f"\nComparison with baseline {baseline.get('commit')}:")
+    for size, stages in report["results"].items():
+        for name, stats in stages.items():
+            old = baseline["results"].get(size, {}).get(name)
+            if old and old["p50_ms"] > 0:
+                print(f"  corpus={size:6s} {name:22s} p50 x{stats['p50_ms'] / old['p50_ms']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RAG pipeline stage by stage")
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[10, 100], help="Number of DOCX files per run")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max-new-tokens", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=None, help="Document parsing processes")
+    parser.add_argument("--stub-tokens-per-second", type=float, default=None,
+                        help="Simulated generation speed of the stub LLM (default: instant)")
+    parser.add_argument("--real-models", action="store_true", help="Use the HuggingFace models instead of stubs")
+    parser.add_argument("--compare-backends", nargs="+", metavar="BACKEND",
+                        help="Instead of the pipeline benchmark, compare LLM inference backends "
+                             "(eager, int8, compile, onnx) for parity and speed")
+    parser.add_argument("--compare-indexes", nargs="+", metavar="INDEX_TYPE",
+                        help="Instead of the pipeline benchmark, report recall/latency of vector index types "
+                             "(sq8, ivfpq, hnsw) against the flat index")
+    parser.add_argument("--corpus-dir", help="Real document directory for --compare-indexes (default: synthetic)")
+    parser.add_argument("--queries-file", help="Text file with one query per line for --compare-indexes")
+    parser.add_argument("--num-threads", type=int, default=None, help="Torch/ONNX Runtime threads for --compare-backends")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to save the JSON report")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    if args.compare_backends:
+        print("Comparing inference backends against eager:")
+        results = compare_backends(args.compare_backends, max_new_tokens=args.max_new_tokens // 4,
+                                   num_threads=args.num_threads)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"commit": _git_commit(), "backends": results}, f, indent=2)
+        print(f"\nReport saved to {args.output}")
+        return
+
+    if args.compare_indexes:
+        if not args.real_models:
+            use_stub_embeddings()
+        queries = None
+        if args.queries_file:
+            with open(args.queries_file, "r", encoding="utf-8") as f:
+                queries = [line.strip() for line in f if line.strip()]
+        results = compare_indexes(args.compare_indexes, args.corpus_dir, queries)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"commit": _git_commit(), "indexes": results}, f, indent=2)
+        print(f"\nReport saved to {args.output}")
+        return
+
+    count_tokens = None
+    if args.real_models:
+        from llm_connector import get_llm
+        llm = get_llm()
+    else:
+        use_stub_embeddings()
+        llm = StubLLM(args.stub_tokens_per_second)
+        from context_packing import approx_token_counts
+
+        # context packing counts tokens approximately instead of loading GPT-2's tokenizer
+        count_tokens = approx_token_counts
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "stub": not args.real_models,
+        "results": run(args.corpus_sizes, args.repeats, llm, args.max_new_tokens, args.workers, count_tokens),
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nReport saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""RAG chat path shared by the Streamlit app and offline tools."""
+from context_packing import CONTEXT_TOKENS, pack_context, tokenizer_token_counts
+from lexical_index import hybrid_search
+from telemetry import span
+
+RAG_TOP_K = 3
+MAX_NEW_TOKENS = 200
+# ثابت و در ابتدای همه پرامپت‌ها، تا حالت KV آن بین همه درخواست‌ها مشترک باشد
+RAG_INSTRUCTION = "به سؤال دانشجو با استفاده از اطلاعات مرتبط، دقیق و کامل پاسخ بده.\n\n"
+
+
+def build_rag_segments(question, docs, history=(), context=None):
+    """
+    Build the RAG prompt as a list of segments for llm_connector's prefix KV cache.
+
+    The constant instruction is the shared first segment. The session's history, the
+    question and its context follow as one segment, tokenized as a whole: the history
+    window slides by a whole exchange on almost every turn, so its KV states would not
+    be shared between prompts. context, if given (see pack_docs), replaces the plain
+    concatenation of the docs.
+    """
+    if context is None:
+        context = "\n".join([doc.page_content for doc in docs])
+    return [RAG_INSTRUCTION, "".join(history) + f"سؤال: {question}\n\nاطلاعات مرتبط:\n{context}\n\nپاسخ مفصل:"]
+
+
+def build_rag_prompt(question, docs, history=()):
+    return "".join(build_rag_segments(question, docs, history))
+
+
+def extract_generated_text(output, prompt):
+    """Turn a text-generation pipeline output into the answer text without the prompt."""
+    if isinstance(output, list) and len(output) > 0 and isinstance(output[0], dict):
+        output = output[0].get("generated_text", "")
+    else:
+        output = str(output)
+
+    if output.startswith(prompt):
+        return output[len(prompt):].strip()
+    return output.strip()
+
+
+def pack_docs(question, docs, vector_store, max_tokens=CONTEXT_TOKENS, count_tokens=None):
+    """
+    Deduplicated, relevance-ranked context from docs within max_tokens tokens, counted
+    with GPT-2's tokenizer unless a count_tokens(texts) function is given.
+    """
+    if count_tokens is None:
+        from resources import MODEL_NAME, get_causal_lm
+
+        count_tokens = tokenizer_token_counts(get_causal_lm(MODEL_NAME)[0])
+    return pack_context(question, docs, vector_store.embeddings, count_tokens, max_tokens)
+
+
+def retrieve_docs(question, vector_store, k=RAG_TOP_K):
+    """The k chunks for a question: hybrid BM25 + vector search when the store has a lexical index."""
+    lexical_index = getattr(vector_store, "lexical_index", None)
+    with span("retrieval", k=k, hybrid=lexical_index is not None):
+        if lexical_index is not None:
+            return hybrid_search(question, vector_store, lexical_index, k)
+        return vector_store.similarity_search(question, k=k)
+
+
+def retrieve_prompt(question, vector_store, k=RAG_TOP_K, history=()):
+    """Retrieve context for a question and return the prompt segments."""
+    docs = retrieve_docs(question, vector_store, k)
+    with span("prompt_assembly") as s:
+        segments = build_rag_segments(question, docs, history, pack_docs(question, docs, vector_store))
+        s.set(prompt_chars=sum(len(segment) for segment in segments))
+    return segments
+
+
+def retrieve_prompts(questions, vector_store, k=RAG_TOP_K):
+    """Batched retrieve_prompt: all questions are embedded with a single embedding call."""
+    lexical_index = getattr(vector_store, "lexical_index", None)
+    embeddings = vector_store.embeddings
+    with span("retrieval", k=k, batch_size=len(questions)):
+        # questions are not added to the embedding cache
+        vectors = getattr(embeddings, "embed_queries", embeddings.embed_documents)(list(questions))
+        if lexical_index is not None:
+            results = [
+                hybrid_search(question, vector_store, lexical_index, k, query_vector=vector)
+                for question, vector in zip(questions, vectors)
+            ]
+        else:
+            results = [vector_store.similarity_search_by_vector(vector, k=k) for vector in vectors]
+    with span("prompt_assembly", batch_size=len(questions)):
+        return [
+            build_rag_segments(question, docs, context=pack_docs(question, docs, vector_store))
+            for question, docs in zip(questions, results)
+        ]
+
+
+def answer_question(question, llm, vector_store, k=RAG_TOP_K, max_new_tokens=MAX_NEW_TOKENS, history=(), response_cache=None):
+    """
+    Retrieve context for a question and generate the full answer in one call.
+
+    With a response_cache, a semantically equivalent earlier question short-circuits
+    retrieval and generation, and new answers are added to the cache.
+    """
+    corpus_version = getattr(vector_store, "corpus_version", None)
+    if response_cache is not None:
+        with span("response_cache_lookup"):
+            cached = response_cache.lookup(question, corpus_version)
+        if cached is not None:
+            return cached
+
+    segments = retrieve_prompt(question, vector_store, k, history)
+    output = llm(segments, max_new_tokens=max_new_tokens)
+    answer = extract_generated_text(output, "".join(segments))
+
+    if response_cache is not None and answer:
+        response_cache.add(question, answer, corpus_version)
+    return answer
@@ -0,0 +1,112 @@
+"""
+Context assembly between retrieval and generation.
+
+pack_context turns the retrieved chunks into a prompt context of at most
+max_tokens tokens:
+
+1. chunks of the same source that are contained in another chunk are dropped,
+   and the text a chunk shares with the end of another (the splitter's
+   CHUNK_OVERLAP) is cut off;
+2. the chunks are split into sentences and repeated sentences are removed;
+3. sentences are ranked by cosine similarity to the question using the (cached)
+   embedder and added best-first while they fit the token budget, measured
+   with the real tokenizer;
+4. the selected sentences are put back in document order.
+
+The prompt size is therefore bounded no matter how many chunks are retrieved.
+"""
+import re
+
+import numpy as np
+
+CONTEXT_TOKENS = 384
+MIN_OVERLAP = 40
+SEPARATOR = "\n"
+
+_SENTENCE_END = re.compile(r"(?<=[.!?؟])\s+|\n+")
+
+
+def approx_token_counts(texts):
+    """Rough token counts used when no tokenizer is given."""
+    return [len(text) // 3 + 1 for text in texts]
+
+
+def tokenizer_token_counts(tokenizer):
+    """count_tokens function measuring a list of texts with a Hugging Face tokenizer in one call."""
+    def count_tokens(texts):
+        if not texts:
+            return []
+        return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+    return count_tokens
+
+
+def _overlap(left, right):
+    """Length of the longest suffix of left that is a prefix of right (at least MIN_OVERLAP)."""
+    for size in range(min(len(left), len(right)), MIN_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def dedupe_chunks(docs):
+    """Texts of docs with chunks contained in others dropped and overlaps with same-source chunks cut."""
+    texts = []
+    sources = []
+    for doc in docs:
+        text = doc.page_content.strip()
+        source = doc.metadata.get("source")
+        same_source = [i for i, other in enumerate(sources) if other == source]
+        if not text or any(text in texts[i] for i in same_source):
+            continue
+        # a new chunk that contains earlier ones replaces them
+        for i in reversed(same_source):
+            if texts[i] in text:
+                del texts[i], sources[i]
+        for i, other in enumerate(texts):
+            if sources[i] == source:
+                text = text[_overlap(other, text):].strip()
+        if text:
+            texts.append(text)
+            sources.append(source)
+    return texts
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+
+def pack_context(question, docs, embeddings=None, count_tokens=approx_token_counts, max_tokens=CONTEXT_TOKENS):
+    """Context text for a question from retrieved docs, within max_tokens (see module docstring)."""
+    sentences, positions, seen = [], [], set()
+    for chunk_index, text in enumerate(dedupe_chunks(docs)):
+        for sentence_index, sentence in enumerate(split_sentences(text)):
+            if sentence not in seen:
+                seen.add(sentence)
+                sentences.append(sentence)
+                positions.append((chunk_index, sentence_index))
+    if not sentences:
+        return ""
+
+    lengths = count_tokens(sentences)
+    separator_tokens = count_tokens([SEPARATOR])[0]
+    if sum(lengths) + separator_tokens * (len(sentences) - 1) <= max_tokens:
+        return SEPARATOR.join(sentences)
+
+    if embeddings is not None:
+        vectors = np.asarray(embeddings.embed_documents(sentences), dtype=np.float32)
+        query = np.asarray(embeddings.embed_query(question), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        order = np.argsort(-(vectors @ query), kind="stable")
+    else:
+        # without an embedder, keep retrieval order
+        order = np.arange(len(sentences))
+
+    budget = max_tokens
+    selected = []
+    for index in order.tolist():
+        cost = lengths[index] + (separator_tokens if selected else 0)
+        if cost <= budget:
+            selected.append(index)
+            budget -= cost
+    selected.sort(key=lambda index: positions[index])
+    return SEPARATOR.join(sentences[index] for index in selected)
@@ -0,0 +1,162 @@
+"""
+Token-budgeted conversation memory for long advising sessions.
+
+Recent turns are kept verbatim in a sliding window. A turn that falls out of the
+window is compressed into a one-line extract and, when an embedder is given,
+stored with a float16 embedding so it can be recalled later for a related
+question. history() returns the summaries most relevant to the current
+question followed by the recent turns, within max_tokens as measured by
+count_tokens (pass tokenizer_counter(tokenizer) to use GPT-2's real tokenizer).
+
+A session holds at most window_turns turns and max_summaries summaries of about
+SUMMARY_CHARS characters each, so thousands of sessions fit in RAM.
+"""
+import re
+from collections import deque
+from typing import Any
+
+import numpy as np
+from langchain_core.memory import BaseMemory
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+HISTORY_TOKENS = 256
+WINDOW_TURNS = 6
+MAX_SUMMARIES = 32
+SUMMARY_CHARS = 160
+RECALLED_SUMMARIES = 3
+ROLE_LABELS = {"user": "کاربر: ", "assistant": "مشاور: "}
+
+_SENTENCE_END = re.compile(r"(?<=[.!?؟])\s+|\n+")
+
+
+def approx_tokens(text):
+    """Rough token count used when no tokenizer is given."""
+    return len(text) // 3 + 1
+
+
+def tokenizer_counter(tokenizer):
+    """count_tokens function measuring text with a Hugging Face tokenizer."""
+    return lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def summarize_turn(role, text, max_chars=SUMMARY_CHARS):
+    """Extractive summary of a turn: its first sentence, cut to max_chars."""
+    first = _SENTENCE_END.split(text.strip(), maxsplit=1)[0]
+    if len(first) > max_chars:
+        first = first[:max_chars].rsplit(" ", 1)[0] + "…"
+    return ROLE_LABELS.get(role, "") + first
+
+
+class ConversationMemory:
+    __slots__ = ("max_tokens", "window_turns", "max_summaries", "count_tokens", "embeddings", "summarize",
+                 "turns", "summaries", "vectors")
+
+    def __init__(self, max_tokens=HISTORY_TOKENS, window_turns=WINDOW_TURNS, max_summaries=MAX_SUMMARIES,
+                 count_tokens=approx_tokens, embeddings=None, summarize=summarize_turn):
+        self.max_tokens = max_tokens
+        self.window_turns = window_turns
+        self.max_summaries = max_summaries
+        self.count_tokens = count_tokens
+        self.embeddings = embeddings
+        self.summarize = summarize
+        # (role, text, token count)
+        self.turns = deque()
+        # (summary, token count)
+        self.summaries = deque()
+        self.vectors = None
+
+    def __len__(self):
+        return len(self.turns) + len(self.summaries)
+
+    def add(self, role, text):
+        """Append a turn ("user" or "assistant"), compressing turns that leave the window."""
+        text = text.strip()
+        if not text:
+            return
+        self.turns.append((role, text, self.count_tokens(ROLE_LABELS.get(role, "") + text + "\n")))
+        window_tokens = sum(tokens for _, _, tokens in self.turns)
+        while len(self.turns) > 1 and (len(self.turns) > self.window_turns or window_tokens > self.max_tokens):
+            old_role, old_text, tokens = self.turns.popleft()
+            window_tokens -= tokens
+            self._add_summary(self.summarize(old_role, old_text))
+
+    def _add_summary(self, summary):
+        self.summaries.append((summary, self.count_tokens(summary + "\n")))
+        if self.embeddings is not None:
+            vector = np.asarray(self.embeddings.embed_query(summary), dtype=np.float32)
+            vector /= max(float(np.linalg.norm(vector)), 1e-12)
+            vector = vector.astype(np.float16)[None, :]
+            self.vectors = vector if self.vectors is None else np.concatenate([self.vectors, vector])
+        if len(self.summaries) > self.max_summaries:
+            self.summaries.popleft()
+            if self.vectors is not None:
+                self.vectors = self.vectors[1:]
+
+    def _recall(self, query, count):
+        """Indices of the summaries to include, in chronological order."""
+        if not self.summaries or count <= 0:
+            return []
+        if query and self.vectors is not None:
+            query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+            scores = self.vectors.astype(np.float32) @ query_vector
+            return sorted(np.argsort(-scores)[:count].tolist())
+        return list(range(max(0, len(self.summaries) - count), len(self.summaries)))
+
+    def history(self, query=None, max_tokens=None):
+        """
+        (role, text) pairs to put in the prompt: recalled summaries (role "summary")
+        followed by the newest turns that fit in max_tokens.
+        """
+        budget = self.max_tokens if max_tokens is None else max_tokens
+        recent = []
+        for role, text, tokens in reversed(self.turns):
+            if tokens > budget:
+                break
+            recent.append((role, text))
+            budget -= tokens
+        recent.reverse()
+
+        recalled = []
+        for index in self._recall(query, RECALLED_SUMMARIES):
+            summary, tokens = self.summaries[index]
+            if tokens <= budget:
+                recalled.append(("summary", summary))
+                budget -= tokens
+        return recalled + recent
+
+    def segments(self, query=None, max_tokens=None):
+        """history() as prompt lines, one per turn (see chat.build_rag_segments)."""
+        return [
+            (text if role == "summary" else ROLE_LABELS.get(role, "") + text) + "\n"
+            for role, text in self.history(query, max_tokens)
+        ]
+
+    def clear(self):
+        self.turns.clear()
+        self.summaries.clear()
+        self.vectors = None
+
+
+class TokenBudgetChatMemory(BaseMemory):
+    """LangChain memory backed by ConversationMemory, for ConversationalRetrievalChain."""
+
+    memory: Any
+    memory_key: str = "chat_history"
+    input_key: str = "question"
+    output_key: str = "answer"
+
+    @property
+    def memory_variables(self):
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs):
+        messages = {"summary": SystemMessage, "user": HumanMessage, "assistant": AIMessage}
+        history = self.memory.history(inputs.get(self.input_key))
+        return {self.memory_key: [messages[role](content=text) for role, text in history]}
+
+    def save_context(self, inputs, outputs):
+        self.memory.add("user", inputs[self.input_key])
+        self.memory.add("assistant", outputs[self.output_key])
+
+    def clear(self):
+        self.memory.clear()
@@ -0,0 +1,195 @@
+"""
+Embeddings wrapper with a content-addressed on-disk cache.
+
+Texts are keyed by the SHA-256 of their content, identical texts are embedded
+once, and only cache misses are sent to the wrapped model in batches. The cache
+is one .npy file of (32-byte key, float16/float32 vector) records that is
+memory-mapped on load.
+
+Several processes (serve.py workers, the batch CLI) share the cache file. A save
+takes an exclusive lock on "<cache_path>.lock", merges in the vectors other
+processes saved since, writes a temporary file in the same directory and
+replaces the cache with it, so readers always see a complete file.
+
+Only documents are cached; queries (user questions, cache lookups) are unique
+most of the time and go straight to the model. New vectors are written to disk
+every max_unsaved additions, so a long-running server neither loses them nor
+keeps them all in memory; without a cache_path at most max_unsaved are kept.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 64
+MAX_UNSAVED = 4096
+KEY_SIZE = 32
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, cache_path=None, batch_size=DEFAULT_BATCH_SIZE, dtype="float16",
+                 max_unsaved=MAX_UNSAVED):
+        self.embeddings = embeddings
+        self.cache_path = cache_path
+        self.batch_size = batch_size
+        self.max_unsaved = max_unsaved
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._base = None
+        self._new = []
+        self._new_keys = []
+        self._dirty = False
+        if cache_path:
+            self._load()
+
+    def _path(self):
+        return f"{self.cache_path}.npy"
+
+    def _read(self):
+        """The records on disk (memory-mapped), or None if there is no valid cache file."""
+        path = self._path()
+        if not os.path.exists(path):
+            return None
+        try:
+            records = np.load(path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable embedding cache %s: %s", path, e)
+            return None
+        names = records.dtype.names or ()
+        if (names != ("key", "vector") or records.dtype["key"].itemsize != KEY_SIZE
+                or len(records.dtype["vector"].shape) != 1):
+            logger.warning("Ignoring embedding cache %s with unexpected layout %s", path, records.dtype)
+            return None
+        return records
+
+    def _load(self):
+        records = self._read()
+        if records is None:
+            return
+        keys, vectors = records["key"], records["vector"]
+        if len(keys) != len(vectors):
+            logger.warning("Ignoring embedding cache %s: %d keys but %d vectors", self._path(), len(keys), len(vectors))
+            return
+        self._base = vectors
+        self._rows = {key.tobytes(): row for row, key in enumerate(keys)}
+
+    def _vector(self, row):
+        base_size = 0 if self._base is None else len(self._base)
+        vector = self._base[row] if row < base_size else self._new[row - base_size]
+        return vector.astype(np.float32).tolist()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def embed_documents(self, texts):
+        keys = [text_key(text) for text in texts]
+
+        with self._lock:
+            misses = {}
+            for key, text in zip(keys, texts):
+                if key not in self._rows and key not in misses:
+                    misses[key] = text
+
+        miss_keys = list(misses)
+        computed = {}
+        for start in range(0, len(miss_keys), self.batch_size):
+            batch_keys = miss_keys[start:start + self.batch_size]
+            vectors = self.embeddings.embed_documents([misses[key] for key in batch_keys])
+            with self._lock:
+                for key, vector in zip(batch_keys, vectors):
+                    computed[key] = list(vector)
+                    if key in self._rows or (not self.cache_path and len(self._new) >= self.max_unsaved):
+                        continue
+                    self._rows[key] = len(self._rows)
+                    self._new.append(np.asarray(vector, dtype=self.dtype))
+                    self._new_keys.append(key)
+                    self._dirty = True
+
+        with self._lock:
+            result = [computed[key] if key in computed else self._vector(self._rows[key]) for key in keys]
+            flush = self.cache_path and len(self._new) >= self.max_unsaved
+        if flush:
+            self.save()
+        return result
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts):
+        """Embed several queries in one call, bypassing the cache."""
+        return self.embeddings.embed_documents(list(texts))
+
+    def save(self):
+        """Merge new vectors into the cache file if any were added since the last load/save."""
+        if not self.cache_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            with open(f"{self.cache_path}.lock", "a") as lock:
+                # one writer at a time across processes; the file on disk may be newer than ours
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._merge_and_write()
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            self._new = []
+            self._new_keys = []
+            self._dirty = False
+            self._load()
+
+    def _merge_and_write(self):
+        new_vectors = np.stack(self._new)
+        dim = new_vectors.shape[1]
+        disk = self._read()
+        if disk is not None and disk.dtype["vector"].shape != (dim,):
+            logger.warning("Replacing embedding cache %s with vectors of a different size", self._path())
+            disk = None
+        known = set() if disk is None else {key.tobytes() for key in disk["key"]}
+        # vectors we loaded earlier are normally still on disk; keep them if another writer dropped them
+        parts = [] if disk is None else [(disk["key"], disk["vector"])]
+        if self._base is not None and len(self._base) and self._base.shape[1:] == (dim,):
+            base_keys = [None] * len(self._base)
+            for key, row in self._rows.items():
+                if row < len(self._base):
+                    base_keys[row] = key
+            rows = [row for row, key in enumerate(base_keys) if key is not None and key not in known]
+            if rows:
+                parts.append((np.array([np.frombuffer(base_keys[row], np.uint8) for row in rows]), self._base[rows]))
+                known.update(base_keys[row] for row in rows)
+        rows = [row for row, key in enumerate(self._new_keys) if key not in known]
+        if rows:
+            keys = np.array([np.frombuffer(self._new_keys[row], np.uint8) for row in rows])
+            parts.append((keys, new_vectors[rows]))
+
+        records = np.empty(sum(len(keys) for keys, _ in parts),
+                           dtype=[("key", np.uint8, (KEY_SIZE,)), ("vector", self.dtype, (dim,))])
+        start = 0
+        for keys, vectors in parts:
+            records["key"][start:start + len(keys)] = keys
+            records["vector"][start:start + len(keys)] = vectors
+            start += len(keys)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, records)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path())
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
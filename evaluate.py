@@ -1,31 +1,58 @@
+import argparse
+import hashlib
 import json
 import os
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import traceback
+from typing import Any
 from llm_connector import get_llm
 from knowledge_base import load_vector_store
 from langchain.chains import ConversationalRetrievalChain
-from langchain.memory import ConversationBufferMemory
+from langchain_core.language_models.llms import LLM
+from chat import MAX_NEW_TOKENS, extract_generated_text
+from conversation_memory import ConversationMemory, TokenBudgetChatMemory, tokenizer_counter
+from resources import MODEL_NAME, get_causal_lm
+from scoring import DEFAULT_METRICS, METRICS, score, token_overlap
+from spider_data import find_spider_files, open_dataset
+
+class AdvisorLLM(LLM):
+    """LangChain LLM around a get_llm generate function; returns only the generated continuation"""
+    generate_fn: Any
+    max_new_tokens: int = MAX_NEW_TOKENS
+
+    @property
+    def _llm_type(self):
+        return "gpt2-fa"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        return extract_generated_text(self.generate_fn(prompt, max_new_tokens=self.max_new_tokens), prompt)
 
 def load_model():
-    """Load the LLM model and QA chain"""
+    """
+    Load the LLM model and a factory of QA chains
+
+    Every call of the factory returns a chain with its own memory, so concurrently
+    evaluated samples never see each other's questions and results do not depend on
+    scheduling or on which samples a resumed run skips.
+    """
     try:
-        llm = get_llm("ollama")
+        # the evaluation workers' prompts are batched together on the shared GenerationServer
+        llm = AdvisorLLM(generate_fn=get_llm(batched=True))
         vector_store = load_vector_store()
+        count_tokens = tokenizer_counter(get_causal_lm(MODEL_NAME)[0])
         
-        memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
-        
-        qa_chain = ConversationalRetrievalChain.from_llm(
-            llm=llm,
-            retriever=vector_store.as_retriever(),
-            memory=memory
-        )
+        def make_qa_chain():
+            # only a token-bounded window of the history (plus short summaries) is sent with each question
+            memory = TokenBudgetChatMemory(memory=ConversationMemory(count_tokens=count_tokens))
+            return ConversationalRetrievalChain.from_llm(
+                llm=llm,
+                retriever=vector_store.as_retriever(),
+                memory=memory
+            )
         
-        return llm, qa_chain
+        return llm, make_qa_chain
     except Exception as e:
         print(f"Error loading model: {str(e)}")
         traceback.print_exc()
@@ -34,35 +61,26 @@ def load_model():
 def explore_directory(directory):
     """
     Explore the directory to find JSON files that could contain Spider test data
-    Returns a list of potential test data files
+    Returns a list of potential test data files; only the first item of each file is parsed
     """
-    potential_files = []
-    
     if not os.path.exists(directory):
         print(f"Directory not found: {directory}")
-        return potential_files
+        return []
     
-    for file in os.listdir(directory):
-        file_path = os.path.join(directory, file)
-        if file.endswith('.json') and os.path.isfile(file_path):
-            # Check if file is likely to contain Spider format data
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                # Spider files should be lists of dictionaries
-                if isinstance(data, list) and len(data) > 0 and isinstance(data[0], dict):
-                    # Check for common Spider fields
-                    if 'question' in data[0] or 'utterance' in data[0]:
-                        potential_files.append((file, file_path))
-            except:
-                # Skip files that can't be parsed
-                pass
-    
-    return potential_files
+    return [(file, file_path) for file, file_path, _ in find_spider_files(directory)]
+
+def load_spider_test_data(spider_data_dir, file_name=None, fields=None, db_ids=None, sample=None, seed=0):
+    """
+    Load test data from the Spider dataset format through the columnar cache in spider_data.py
 
-def load_spider_test_data(spider_data_dir):
-    """Load test data from the Spider dataset format with more robust error handling"""
+    Args:
+        spider_data_dir: Directory containing the Spider JSON files
+        file_name: File to use; asks interactively when None
+        fields: (question_field, database_field, sql_field); detected from the data when None
+        db_ids: Only load samples of these databases
+        sample: Load a random sample of this many items (None for all)
+        seed: Random seed for the sample
+    """
     
     test_data = []
     
@@ -78,131 +96,141 @@ def load_spider_test_data(spider_data_dir):
     for i, (filename, filepath) in enumerate(potential_files):
         print(f"{i+1}. {filename}")
     
-    # Let the user choose which file to use
-    try:
-        choice = int(input("Enter the number of the file to use for evaluation: ")) - 1
-        if 0 <= choice < len(potential_files):
-            file_name, file_path = potential_files[choice]
-        else:
-            print("Invalid choice, using first file.")
+    if file_name is not None:
+        matches = [f for f in potential_files if f[0] == file_name]
+        if not matches:
+            print(f"File {file_name} is not a Spider test file.")
+            return test_data
+        file_name, file_path = matches[0]
+    else:
+        # Let the user choose which file to use
+        try:
+            choice = int(input("Enter the number of the file to use for evaluation: ")) - 1
+            if 0 <= choice < len(potential_files):
+                file_name, file_path = potential_files[choice]
+            else:
+                print("Invalid choice, using first file.")
+                file_name, file_path = potential_files[0]
+        except:
+            print("Invalid input, using first file.")
             file_name, file_path = potential_files[0]
-    except:
-        print("Invalid input, using first file.")
-        file_name, file_path = potential_files[0]
     
     print(f"Loading data from: {file_name}")
     
-    # Load the selected JSON file
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    # The first run converts the JSON file into a memory-mapped cache; later runs open it directly
+    if fields is not None:
+        fields = dict(zip(("question", "db_id", "gold_query"), fields))
+    dataset = open_dataset(file_path, fields)
+    
+    print(f"Found {len(dataset)} items in the file.")
+    print(f"Fields: {dataset.manifest['fields']}")
     
-    print(f"Found {len(data)} items in the file.")
+    return dataset.sample(sample, db_ids, seed)
+
+def evaluate_item(qa_chain, item):
+    """Run one test sample through the QA chain and return its result row"""
+    question = item['question']
+    gold_query = item['gold_query']
+    db_id = item['db_id']
+    
+    # Add database context to the question
+    question_with_context = f"Database: {db_id}\nQuestion: {question}"
     
-    # Print sample of data structure to understand format
-    if len(data) > 0:
-        print("Sample data structure:")
-        print(json.dumps(data[0], indent=2))
+    # Get model's response
+    try:
+        result = qa_chain({"question": question_with_context})
+        model_answer = result["answer"]
         
-        # Ask for field mapping
-        print("\nPlease identify the field names in your data:")
-        question_field = input("Field name for question (common: 'question', 'utterance'): ")
-        database_field = input("Field name for database ID (common: 'db_id', 'database'): ")
-        sql_field = input("Field name for SQL query (common: 'query', 'sql'): ")
+        # Simple word overlap score against the gold SQL query
+        score = calculate_text_overlap(model_answer, gold_query)
         
-        # Process data with user-specified fields
-        for item in data:
-            question = item.get(question_field, "")
-            db_id = item.get(database_field, "")
-            gold_query = item.get(sql_field, "")
-            
-            test_data.append({
-                'question': question,
-                'db_id': db_id,
-                'gold_query': gold_query
-            })
-            
-    return test_data
+        return {
+            'question': question,
+            'database': db_id,
+            'gold_query': gold_query,
+            'model_response': model_answer,
+            'relevance_score': score
+        }
+        
+    except Exception as e:
+        print(f"Error processing question: {question}\nError: {str(e)}")
+        return {
+            'question': question,
+            'database': db_id,
+            'gold_query': gold_query,
+            'model_response': "ERROR",
+            'relevance_score': 0.0
+        }
+
+def sample_id(index, item):
+    """Stable id of a test sample, used to match checkpoint rows to samples on restart"""
+    key = json.dumps([item['db_id'], item['question'], item['gold_query']], ensure_ascii=False)
+    return f"{index}:{hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]}"
 
-def evaluate_model(qa_chain, test_data, num_samples=None):
+def load_checkpoint(checkpoint_path):
+    """Read finished results from a JSONL checkpoint, ignoring a torn last line"""
+    done = {}
+    if not os.path.exists(checkpoint_path):
+        return done
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            done[row['sample_id']] = row
+    return done
+
+def run_evaluation(make_qa_chain, test_data, checkpoint_path, num_samples=None, max_workers=4):
     """
-    Evaluate the model using test data from Spider
+    Evaluate test samples concurrently and append each result to a JSONL checkpoint
+    as soon as it finishes. Samples already answered in the checkpoint are skipped,
+    so an interrupted run continues where it stopped.
     
     Args:
-        qa_chain: The QA chain to evaluate
+        make_qa_chain: Returns a fresh QA chain; each sample gets its own, so no chat
+            history is shared between concurrently evaluated samples
         test_data: List of test data dictionaries
+        checkpoint_path: JSONL file results are appended to
         num_samples: Number of samples to evaluate (None for all)
+        max_workers: Number of samples evaluated at the same time
     """
     if not test_data:
         print("No test data available for evaluation.")
         return pd.DataFrame()
-        
-    results = []
     
-    # Limit number of samples if specified
     if num_samples is not None and num_samples < len(test_data):
         test_data = test_data[:num_samples]
     
-    for item in tqdm(test_data, desc="Evaluating model"):
-        question = item['question']
-        gold_query = item['gold_query']
-        db_id = item['db_id']
-        
-        # Add database context to the question
-        question_with_context = f"Database: {db_id}\nQuestion: {question}"
-        
-        # Get model's response
-        try:
-            result = qa_chain({"question": question_with_context})
-            model_answer = result["answer"]
-            
-            # Simple word overlap score
-            score = calculate_text_overlap(model_answer, question)
-            
-            results.append({
-                'question': question,
-                'database': db_id,
-                'gold_query': gold_query,
-                'model_response': model_answer,
-                'relevance_score': score
-            })
-            
-        except Exception as e:
-            print(f"Error processing question: {question}\nError: {str(e)}")
-            results.append({
-                'question': question,
-                'database': db_id,
-                'gold_query': gold_query,
-                'model_response': "ERROR",
-                'relevance_score': 0.0
-            })
-    
-    return pd.DataFrame(results)
+    ids = [sample_id(i, item) for i, item in enumerate(test_data)]
+    done = load_checkpoint(checkpoint_path)
+    # failed samples are retried; later checkpoint lines override earlier ones
+    pending = [
+        (sid, item) for sid, item in zip(ids, test_data)
+        if sid not in done or done[sid]['model_response'] == "ERROR"
+    ]
+    if done:
+        print(f"Resuming: {len(test_data) - len(pending)} samples already in {checkpoint_path}")
+    
+    with open(checkpoint_path, 'a', encoding='utf-8') as f, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(evaluate_item, make_qa_chain(), item): sid for sid, item in pending}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Evaluating model"):
+            row = future.result()
+            row['sample_id'] = futures[future]
+            done[row['sample_id']] = row
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.flush()
+    
+    return pd.DataFrame([done[sid] for sid in ids])
 
-def calculate_text_overlap(response, question):
+def calculate_text_overlap(response, reference):
     """
-    Calculate a simple text overlap score between response and question
-    This measures how relevant the response is to the question
+    Share of the reference's words (minus stop words) that appear in the response.
+    Single-row version of the relevance_score metric in scoring.py
     """
-    if not response or not question:
-        return 0.0
-    
-    # Convert to lowercase and split into words
-    response_words = set(str(response).lower().split())
-    question_words = set(str(question).lower().split())
-    
-    # Remove common stop words
-    stop_words = {"the", "a", "an", "and", "or", "but", "is", "are", "was", "were",
-                 "in", "on", "at", "to", "for", "with", "by", "about", "like", "from"}
-    
-    response_words = response_words - stop_words
-    question_words = question_words - stop_words
-    
-    # Calculate overlap
-    if not question_words:
+    if not response or not reference:
         return 0.0
-    
-    intersection = response_words.intersection(question_words)
-    return len(intersection) / len(question_words)
+    return float(token_overlap(pd.Series([str(response)]), pd.Series([str(reference)]))[0])
 
 def analyze_results(results_df):
     """Analyze evaluation results"""
@@ -220,16 +248,19 @@ def analyze_results(results_df):
         db_performance = results_df.groupby('database')['relevance_score'].mean().reset_index()
         db_performance = db_performance.sort_values('relevance_score', ascending=False)
     
-    # Find best and worst performing questions
+    # Find best and worst performing questions (one sort for both)
     best_questions = pd.DataFrame()
     worst_questions = pd.DataFrame()
     if 'relevance_score' in results_df.columns:
-        best_questions = results_df.sort_values('relevance_score', ascending=False).head(5)
-        worst_questions = results_df.sort_values('relevance_score', ascending=True).head(5)
+        ranked = results_df.sort_values('relevance_score', ascending=False, kind='stable')
+        best_questions = ranked.head(5)
+        worst_questions = ranked.tail(5).iloc[::-1]
     
     # Summary metrics
     metrics = {
         'avg_relevance_score': avg_score,
+        **{f'avg_{name}': results_df[name].mean() for name in METRICS
+           if name != 'relevance_score' and name in results_df.columns},
         'total_samples': len(results_df),
         'error_count': errors,
         'error_percentage': errors / len(results_df) * 100 if len(results_df) > 0 else 0
@@ -237,22 +268,105 @@ def analyze_results(results_df):
     
     return metrics, db_performance, best_questions, worst_questions
 
+def report(results_df, output_path="spider_evaluation_results.csv"):
+    """Print the analysis of scored results and save them as CSV"""
+    # Analyze results
+    metrics, db_performance, best_questions, worst_questions = analyze_results(results_df)
+    
+    # Print summary
+    print("\n===== Evaluation Results =====")
+    for key, value in metrics.items():
+        print(f"{key}: {value}")
+    
+    if not db_performance.empty:
+        print("\n===== Database Performance =====")
+        print(db_performance.to_string(index=False))
+    
+    if not best_questions.empty:
+        print("\n===== Best Performing Questions =====")
+        for idx, row in best_questions.iterrows():
+            print(f"Q: {row['question']}")
+            print(f"Score: {row['relevance_score']:.2f}")
+            print(f"DB: {row['database']}")
+            print("---")
+    
+    if not worst_questions.empty:
+        print("\n===== Worst Performing Questions =====")
+        for idx, row in worst_questions.iterrows():
+            print(f"Q: {row['question']}")
+            print(f"Score: {row['relevance_score']:.2f}")
+            print(f"DB: {row['database']}")
+            print("---")
+    
+    # Save detailed results
+    results_df.to_csv(output_path, index=False)
+    print(f"\nDetailed results saved to {output_path}")
+
+def load_results(path):
+    """Read a results CSV or a JSONL checkpoint written by run_evaluation"""
+    if path.endswith(".jsonl"):
+        return pd.DataFrame(list(load_checkpoint(path).values()))
+    return pd.read_csv(path, keep_default_na=False)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate the advisor on Spider test data")
+    parser.add_argument("--data-dir", help="Spider data directory; when given, runs without prompts")
+    parser.add_argument("--data-file", help="JSON file inside --data-dir (default: first Spider file found)")
+    parser.add_argument("--fields", nargs=3, metavar=("QUESTION", "DB_ID", "SQL"),
+                        help="Field names in the data file (default: detected from the data)")
+    parser.add_argument("--db-id", nargs="+", dest="db_ids", help="Only evaluate samples of these databases")
+    parser.add_argument("--sample", type=int, help="Evaluate a random sample of N items")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for --sample")
+    parser.add_argument("--num-samples", type=int, help="Evaluate only the first N samples")
+    parser.add_argument("--workers", type=int, default=4, help="Samples evaluated concurrently")
+    parser.add_argument("--checkpoint", default="spider_evaluation_checkpoint.jsonl",
+                        help="JSONL file results are appended to; finished samples are skipped on restart")
+    parser.add_argument("--metrics", nargs="+", default=list(DEFAULT_METRICS), choices=sorted(METRICS),
+                        help="Metrics to compute (see scoring.py)")
+    parser.add_argument("--rescore", metavar="RESULTS",
+                        help="Re-score a results CSV or checkpoint JSONL with --metrics instead of evaluating")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    
+    # Re-score saved results with new metrics without running the model
+    if args.rescore:
+        results_df = load_results(args.rescore)
+        if results_df.empty:
+            print(f"No results in {args.rescore}. Exiting.")
+            return
+        report(score(results_df, args.metrics))
+        return
+    
+    interactive = args.data_dir is None
+
     # Path to your Spider dataset directory
     default_path = "C:\\Users\\Parsa\\Downloads\\spider_data"
-    spider_data_dir = input(f"Enter path to Spider data directory [{default_path}]: ") or default_path
+    if interactive:
+        spider_data_dir = input(f"Enter path to Spider data directory [{default_path}]: ") or default_path
+    else:
+        spider_data_dir = args.data_dir
     
     # Load model
     print("Loading model...")
-    llm, qa_chain = load_model()
+    llm, make_qa_chain = load_model()
     
-    if not llm or not qa_chain:
+    if not llm or not make_qa_chain:
         print("Failed to load the model. Exiting.")
         return
     
     # Load test data
     print("Loading Spider test data...")
-    test_data = load_spider_test_data(spider_data_dir)
+    if interactive:
+        test_data = load_spider_test_data(spider_data_dir, db_ids=args.db_ids, sample=args.sample, seed=args.seed)
+    else:
+        file_name = args.data_file
+        if file_name is None:
+            potential_files = explore_directory(spider_data_dir)
+            file_name = potential_files[0][0] if potential_files else None
+        test_data = load_spider_test_data(spider_data_dir, file_name, args.fields, args.db_ids, args.sample,
+                                          args.seed) if file_name else []
     print(f"Loaded {len(test_data)} test examples")
     
     if not test_data:
@@ -260,8 +374,8 @@ def main():
         return
     
     # Ask user if they want to limit the number of samples
-    use_limit = input("Do you want to limit the number of test samples? (y/n): ").lower() == 'y'
-    num_samples = None
+    use_limit = interactive and input("Do you want to limit the number of test samples? (y/n): ").lower() == 'y'
+    num_samples = args.num_samples
     if use_limit:
         try:
             num_samples = int(input(f"Enter number of samples (max {len(test_data)}): "))
@@ -270,43 +384,14 @@ def main():
     
     # Evaluate model
     print("Evaluating model...")
-    results_df = evaluate_model(qa_chain, test_data, num_samples)
+    results_df = run_evaluation(make_qa_chain, test_data, args.checkpoint, num_samples, args.workers)
     
     if results_df.empty:
         print("No evaluation results generated. Exiting.")
         return
     
-    # Analyze results
-    metrics, db_performance, best_questions, worst_questions = analyze_results(results_df)
-    
-    # Print summary
-    print("\n===== Evaluation Results =====")
-    for key, value in metrics.items():
-        print(f"{key}: {value}")
-    
-    if not db_performance.empty:
-        print("\n===== Database Performance =====")
-        print(db_performance.to_string(index=False))
-    
-    if not best_questions.empty:
-        print("\n===== Best Performing Questions =====")
-        for idx, row in best_questions.iterrows():
-            print(f"Q: {row['question']}")
-            print(f"Score: {row['relevance_score']:.2f}")
-            print(f"DB: {row['database']}")
-            print("---")
-    
-    if not worst_questions.empty:
-        print("\n===== Worst Performing Questions =====")
-        for idx, row in worst_questions.iterrows():
-            print(f"Q: {row['question']}")
-            print(f"Score: {row['relevance_score']:.2f}")
-            print(f"DB: {row['database']}")
-            print("---")
-    
-    # Save detailed results
-    results_df.to_csv("spider_evaluation_results.csv", index=False)
-    print("\nDetailed results saved to spider_evaluation_results.csv")
+    # Score with the selected metrics and analyze the results
+    report(score(results_df, args.metrics))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,37 +1,105 @@
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 import os
+from telemetry import traced
 
-def load_documents(directory_path):
+LOADERS = {
+    ".pdf": PyPDFLoader,
+    ".docx": Docx2txtLoader,
+}
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+
+def _split_file(file_path, source):
+    """Load one file and split it into chunks. Runs inside a worker process."""
+    loader = LOADERS[os.path.splitext(file_path)[1].lower()](file_path)
+    docs = loader.load()
+    for doc in docs:
+        doc.metadata["source"] = source
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP
+    )
+    return text_splitter.split_documents(docs)
+
+
+def _iter_files(directory_path, recursive):
+    """Yield (file_path, source) for every supported file, source being relative to directory_path."""
+    for root, dirs, files in os.walk(directory_path):
+        dirs.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1].lower() in LOADERS:
+                file_path = os.path.join(root, filename)
+                yield file_path, os.path.relpath(file_path, directory_path)
+        if not recursive:
+            break
+
+
+def iter_document_chunks(directory_path, max_workers=None, recursive=True):
+    """
+    Yield chunks from every PDF/DOCX file under directory_path as soon as they are parsed.
+
+    Files are parsed in a process pool with at most two files per worker in flight,
+    so memory use does not grow with the size of the corpus. Chunks of different
+    files are yielded in completion order.
+    """
     if not os.path.exists(directory_path):
         raise FileNotFoundError(f"path does not exist: {directory_path}")
 
-    documents = []
-    for filename in os.listdir(directory_path):
-        file_path = os.path.join(directory_path, filename)
-        try:
-            if filename.endswith(".pdf"):
-                loader = PyPDFLoader(file_path)
-            elif filename.endswith(".docx"):
-                loader = Docx2txtLoader(file_path)
-            else:
-                continue
-
-            docs = loader.load()
-            for doc in docs:
-                doc.metadata["source"] = filename
-            documents.extend(docs)
-
-        except Exception as e:
-            print(f"Error reading file{filename}: {str(e)}")
-            continue
+    files = _iter_files(directory_path, recursive)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    if max_workers == 1:
+        for file_path, source in files:
+            try:
+                yield from _split_file(file_path, source)
+            except Exception as e:
+                print(f"Error reading file{source}: {str(e)}")
+        return
+
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    pending = {}
+    try:
+        def submit(count):
+            for file_path, source in islice(files, count):
+                pending[executor.submit(_split_file, file_path, source)] = source
+
+        submit(max_workers * 2)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                source = pending.pop(future)
+                try:
+                    chunks = future.result()
+                except Exception as e:
+                    print(f"Error reading file{source}: {str(e)}")
+                    continue
+                yield from chunks
+            submit(len(done))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_batches(iterable, batch_size):
+    """Group an iterable into lists of at most batch_size items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+@traced("load_documents")
+def load_documents(directory_path, max_workers=1, recursive=False):
+    documents = list(iter_document_chunks(directory_path, max_workers=max_workers, recursive=recursive))
 
     if not documents:
         raise ValueError(f"No PDF or DOCX files found in path: {directory_path}")
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
-    )
-
-    return text_splitter.split_documents(documents)
+    return documents
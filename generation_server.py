@@ -0,0 +1,154 @@
+"""
+Micro-batching generation server shared by all sessions in a process.
+
+Prompts from every caller go into one queue. A worker thread collects up to
+max_batch_size prompts (waiting at most max_wait_ms after the first one),
+left-pads them into a single batch, runs model.generate once, and routes each
+decoded result back to its caller through a Future.
+"""
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+MAX_BATCH_SIZE = 8
+
+
+class _Request:
+    __slots__ = ("prompt", "kwargs", "future", "enqueued_at")
+
+    def __init__(self, prompt, kwargs):
+        self.prompt = prompt
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class GenerationServer:
+    def __init__(self, tokenizer, model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=20):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._metrics_lock = threading.Lock()
+        self._requests = 0
+        self._batches = 0
+        self._batch_sizes = Counter()
+        self._queue_wait = 0.0
+        self._generate_time = 0.0
+
+        self._worker = threading.Thread(target=self._run, name="generation-server", daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt, **kwargs):
+        """Queue a prompt and return a Future resolving to the decoded prompt + continuation."""
+        if self._stopped.is_set():
+            raise RuntimeError("Generation server is stopped")
+        request = _Request(prompt, kwargs)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, prompt, timeout=None, **kwargs):
+        return self.submit(prompt, **kwargs).result(timeout=timeout)
+
+    def stop(self):
+        self._stopped.set()
+        self._queue.put(None)
+        self._worker.join()
+
+    def metrics(self):
+        """Queue depth and batching statistics for tuning max_batch_size / max_wait_ms."""
+        with self._metrics_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "requests": self._requests,
+                "batches": self._batches,
+                "avg_batch_size": self._requests / self._batches if self._batches else 0.0,
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "avg_queue_wait_ms": 1000 * self._queue_wait / self._requests if self._requests else 0.0,
+                "avg_batch_generate_ms": 1000 * self._generate_time / self._batches if self._batches else 0.0,
+            }
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._stopped.set()
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._collect()
+            if batch is None:
+                break
+
+            # only requests with identical generation settings can share a generate call
+            groups = {}
+            for request in batch:
+                if request.future.set_running_or_notify_cancel():
+                    groups.setdefault(tuple(sorted(request.kwargs.items())), []).append(request)
+            for requests in groups.values():
+                self._generate_batch(requests)
+
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None and request.future.set_running_or_notify_cancel():
+                request.future.set_exception(RuntimeError("Generation server is stopped"))
+
+    def _generate_batch(self, requests):
+        from llm_connector import _generation_kwargs
+
+        started = time.perf_counter()
+        try:
+            inputs = self.tokenizer(
+                [request.prompt for request in requests],
+                return_tensors="pt",
+                padding=True,
+                padding_side="left"
+            )
+            outputs = self.model.generate(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                **_generation_kwargs(requests[0].kwargs)
+            )
+            pad_lengths = (inputs["attention_mask"] == 0).sum(dim=1).tolist()
+            texts = [
+                self.tokenizer.decode(output[pad_length:], skip_special_tokens=True)
+                for output, pad_length in zip(outputs, pad_lengths)
+            ]
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+        else:
+            for request, text in zip(requests, texts):
+                request.future.set_result(text)
+
+        finished = time.perf_counter()
+        with self._metrics_lock:
+            self._requests += len(requests)
+            self._batches += 1
+            self._batch_sizes[len(requests)] += 1
+            self._queue_wait += sum(started - request.enqueued_at for request in requests)
+            self._generate_time += finished - started
@@ -0,0 +1,101 @@
+"""
+CPU inference backends for the causal language model.
+
+- eager:   the model as loaded, fp32 PyTorch
+- int8:    dynamic int8 quantization of every linear layer (GPT-2's Conv1D
+           projections are converted to nn.Linear first so they get quantized too)
+- compile: torch.compile on the forward pass
+- onnx:    ONNX Runtime graph exported with optimum (optional dependency:
+           pip install optimum[onnxruntime]); the export runs once and is saved
+           under ONNX_CACHE_DIR, later processes load it from there
+
+All backends expose the Hugging Face generate() API, so llm_connector's
+custom_generate(prompt, **kwargs) works unchanged on top of any of them.
+"""
+import os
+import shutil
+import tempfile
+
+import torch
+
+BACKENDS = ("eager", "int8", "compile", "onnx")
+ONNX_CACHE_DIR = "onnx_cache"
+
+
+def conv1d_to_linear(model):
+    """Replace transformers' Conv1D layers (used by GPT-2) with equivalent nn.Linear layers in place."""
+    from transformers.pytorch_utils import Conv1D
+
+    for parent in list(model.modules()):
+        for child_name, child in list(parent.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(parent, child_name, linear)
+    return model
+
+
+def supports_kv_reuse(model):
+    """Whether past_key_values can be built with a forward call and passed to generate (PyTorch backends)."""
+    return isinstance(model, torch.nn.Module)
+
+
+def load_causal_lm(name, backend="eager", num_threads=None):
+    """Load (tokenizer, model) for the given backend."""
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    tokenizer = AutoTokenizer.from_pretrained(name)
+
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError as e:
+            raise ImportError("The onnx backend requires optimum: pip install optimum[onnxruntime]") from e
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        if num_threads:
+            session_options.intra_op_num_threads = num_threads
+        return tokenizer, _load_onnx_model(ORTModelForCausalLM, name, session_options)
+
+    model = AutoModelForCausalLM.from_pretrained(name)
+    return tokenizer, optimize_model(model, backend)
+
+
+def _load_onnx_model(model_class, name, session_options, cache_dir=ONNX_CACHE_DIR):
+    """Load the exported ONNX model of `name` from cache_dir, exporting and saving it on first use."""
+    path = os.path.join(cache_dir, name.replace("/", "__"))
+    if not os.path.isdir(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # exported into a temporary directory and renamed, so a concurrent process never
+        # loads a half-written export
+        tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".export-")
+        try:
+            model_class.from_pretrained(name, export=True).save_pretrained(tmp_path)
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process saved the same export first
+            if not os.path.isdir(path):
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return model_class.from_pretrained(path, session_options=session_options)
+
+
+def optimize_model(model, backend):
+    """Apply a PyTorch backend (eager, int8 or compile) to a loaded model."""
+    model.eval()
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif backend == "compile":
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
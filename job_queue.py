@@ -0,0 +1,189 @@
+"""
+Background job queue for generation and planning requests.
+
+The Streamlit script thread only submits work and polls for it:
+
+    job_id = jobs.submit("chat", answer_job, question, timeout=120)
+    job = jobs.get(job_id)          # job.status, job.partial, job.result()
+
+Jobs run on a small thread pool. Submitting a job whose key (by default the kind
+and arguments) matches a queued, running or recently finished job returns the
+existing job id instead of starting a second generation, so Streamlit reruns and
+double clicks never generate twice. Finished jobs are kept for result_ttl seconds.
+
+The job function receives the Job as its first argument; long-running functions
+report progress with job.update(partial) and should stop early once
+job.should_stop() is true (cancelled or past its timeout).
+"""
+import hashlib
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from telemetry import span
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMEOUT = "timeout"
+FINISHED = (DONE, FAILED, CANCELLED, TIMEOUT)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function to abandon a cancelled or timed-out job."""
+
+
+class Job:
+    def __init__(self, kind, key, timeout=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.partial = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.deadline = self.created_at + timeout if timeout else None
+        self.future = None
+        self._cancelled = threading.Event()
+        self._status = QUEUED
+
+    @property
+    def status(self):
+        if self._status in (QUEUED, RUNNING) and self.timed_out():
+            return TIMEOUT
+        return self._status
+
+    def timed_out(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def should_stop(self):
+        return self._cancelled.is_set() or self.timed_out()
+
+    def update(self, partial):
+        """Publish intermediate output (e.g. the text streamed so far)."""
+        self.partial = partial
+
+    def result(self, timeout=None):
+        """Block until the job finishes and return its result (raises its error, or CancelledError)."""
+        return self.future.result(timeout=timeout)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    def __init__(self, max_workers=2, result_ttl=600):
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._by_key = {}
+        self._deduplicated = 0
+
+    def submit(self, kind, fn, *args, key=None, timeout=None, **kwargs):
+        """
+        Run fn(job, *args, **kwargs) in the background and return the job id.
+
+        A live job (or one that finished successfully within result_ttl) with the same
+        key is returned instead of submitting a new one.
+        """
+        key = _job_key(kind, key if key is not None else (args, sorted(kwargs.items())))
+        with self._lock:
+            self._prune()
+            existing = self._jobs.get(self._by_key.get(key))
+            if existing is not None and existing.status in (QUEUED, RUNNING, DONE):
+                self._deduplicated += 1
+                return existing.id
+
+            job = Job(kind, key, timeout)
+            self._jobs[job.id] = job
+            self._by_key[key] = job.id
+            job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+            return job.id
+
+    def get(self, job_id):
+        """The Job for an id, or None if it is unknown or expired."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def result(self, job_id, timeout=None):
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job.result(timeout=timeout)
+
+    def cancel(self, job_id):
+        """Cancel a job; a queued job never starts, a running one is asked to stop."""
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED:
+            return False
+        job._cancelled.set()
+        if job.future.cancel():
+            job._status = CANCELLED
+            job.finished_at = time.time()
+        return True
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+            return {
+                **{status: statuses.count(status) for status in (QUEUED, RUNNING, *FINISHED)},
+                "deduplicated": self._deduplicated,
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job._cancelled.set()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _run(self, job, fn, args, kwargs):
+        if job.should_stop():
+            job._status = TIMEOUT if job.timed_out() else CANCELLED
+            job.finished_at = time.time()
+            raise CancelledError()
+
+        job.started_at = time.time()
+        job._status = RUNNING
+        try:
+            with span("job", kind=job.kind, queue_wait_ms=(job.started_at - job.created_at) * 1000):
+                result = fn(job, *args, **kwargs)
+        except Exception as e:
+            job._status = _stopped_status(job) if isinstance(e, JobCancelled) else FAILED
+            raise
+        finally:
+            job.finished_at = time.time()
+
+        if job.should_stop():
+            # the function returned a truncated result after being stopped
+            job._status = _stopped_status(job)
+        else:
+            job._status = DONE
+        return result
+
+    def _prune(self):
+        cutoff = time.time() - self.result_ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
+                if self._by_key.get(job.key) == job_id:
+                    del self._by_key[job.key]
+
+
+def _stopped_status(job):
+    return CANCELLED if job._cancelled.is_set() else TIMEOUT
+
+
+def _job_key(kind, key):
+    return hashlib.sha256(repr((kind, key)).encode("utf-8")).hexdigest()
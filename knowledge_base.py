@@ -1,17 +1,250 @@
+import hashlib
+import json
+import os
+import pickle
+
+from langchain_community.docstore.document import Document
 from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+from file_processor import iter_batches, iter_document_chunks
+from lexical_index import BM25Index
+from resources import get_embeddings
+from telemetry import traced
+from vector_index import DEFAULT_SHARD, ShardedVectorStore, build_store_from_batches, shard_key
+
+EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+INDEX_PATH = "vector_store"
+INDEX_NAME = "index"
+MANIFEST_NAME = "manifest.json"
+EMBED_BATCH_SIZE = 256
+SHARDS_DIR = "shards"
+SPOOL_DIR = "spool"
+DEFAULT_INDEX_CONFIG = {"index_type": "flat", "shard_by": None}
+# نوع ایندکس (flat, sq8, ivfpq, hnsw) و کلید تقسیم‌بندی (مثلاً faculty)
+INDEX_TYPE = os.environ.get("ADVISOR_INDEX_TYPE", "flat")
+SHARD_BY = os.environ.get("ADVISOR_SHARD_BY") or None
+
+# ایجاد یک پایگاه دانش ساده (برای تست)
+# در عمل، باید مسیر اسناد واقعی را به load_vector_store بدهید
+SAMPLE_TEXTS = ["این یک متن نمونه برای تست است.", "پایگاه دانش برای پاسخ به سؤالات."]
+
+
+def _chunk_id(doc):
+    """Content hash of a chunk, used as its docstore id."""
+    key = f"{doc.metadata.get('source', '')}\0{doc.page_content}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _read_manifest(index_path, index_config):
+    manifest_path = os.path.join(index_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # اگر مدل embedding عوض شده باشد، بردارهای قبلی قابل استفاده نیستند
+    if manifest.get("embedding_model") != EMBEDDING_MODEL:
+        return None
+    if manifest.get("index", DEFAULT_INDEX_CONFIG) != index_config:
+        return None
+    return set(manifest.get("ids", []))
+
+
+def _write_manifest(index_path, ids, index_config):
+    manifest_path = os.path.join(index_path, MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"embedding_model": EMBEDDING_MODEL, "index": index_config, "ids": sorted(ids)}, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def _corpus_version(ids):
+    """Fingerprint of the indexed chunks; changes whenever a chunk is added, edited or removed."""
+    return hashlib.sha256("".join(sorted(ids)).encode("ascii")).hexdigest()
+
+
+def _load_index(index_path, embeddings, mmap=False):
+    """Load a saved FAISS store, memory-mapping the index file when possible."""
+    faiss = dependable_faiss_import()
+    index_file = os.path.join(index_path, f"{INDEX_NAME}.faiss")
+    index = None
+    if mmap:
+        try:
+            index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # not every index type supports mmap; fall back to a regular read
+            index = None
+    if index is None:
+        index = faiss.read_index(index_file)
+
+    # فایل pkl توسط همین ماژول نوشته شده است
+    with open(os.path.join(index_path, f"{INDEX_NAME}.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+def _load_flat_store(chunks, embeddings, index_path, batch_size, lexical):
+    """Incrementally update the single flat index at index_path; returns (store, chunk ids)."""
+    indexed = _read_manifest(index_path, DEFAULT_INDEX_CONFIG)
+    seen = set()
+    vector_store = None
+
+    for batch in iter_batches(chunks, batch_size):
+        new_docs, new_ids = [], []
+        for doc in batch:
+            chunk_id = _chunk_id(doc)
+            if chunk_id in seen:
+                continue
+            seen.add(chunk_id)
+            lexical.add(doc)
+            if indexed is None or chunk_id not in indexed:
+                new_docs.append(doc)
+                new_ids.append(chunk_id)
+
+        if not new_docs:
+            continue
+        if vector_store is None and indexed is None:
+            vector_store = FAISS.from_documents(new_docs, embeddings, ids=new_ids)
+            continue
+        if vector_store is None:
+            vector_store = _load_index(index_path, embeddings)
+        vector_store.add_documents(new_docs, ids=new_ids)
+
+    if not seen:
+        return None, seen
+
+    removed = [i for i in indexed if i not in seen] if indexed is not None else []
+    if vector_store is None:
+        if not removed:
+            return _load_index(index_path, embeddings, mmap=True), seen
+        vector_store = _load_index(index_path, embeddings)
+    if removed:
+        vector_store.delete(removed)
+
+    vector_store.save_local(index_path, INDEX_NAME)
+    _write_manifest(index_path, seen, DEFAULT_INDEX_CONFIG)
+    # serve from the memory-mapped file so forked/other processes share the index pages
+    return _load_index(index_path, embeddings, mmap=True), seen
+
+
+def _load_sharded_store(chunks, embeddings, index_path, batch_size, index_config, lexical):
+    """
+    Load or rebuild a (possibly sharded) store with a trained index type; returns (store, chunk ids).
+
+    Trained indexes cannot be updated in place, so any change to the corpus rebuilds
+    them; the embedding cache keeps the rebuild cheap. While the chunks stream in,
+    each is appended to its shard's spool file on disk and only ids are kept in
+    memory; a rebuild then reads one shard back at a time and embeds it in batches.
+    """
+    shards = {}
+    seen = set()
+    spool_path = os.path.join(index_path, SPOOL_DIR)
+    os.makedirs(spool_path, exist_ok=True)
+    spools = {}
+    try:
+        for doc in chunks:
+            chunk_id = _chunk_id(doc)
+            if chunk_id in seen:
+                continue
+            seen.add(chunk_id)
+            lexical.add(doc)
+            name = shard_key(doc, index_config["shard_by"])
+            shards[name] = shards.get(name, 0) + 1
+            if name not in spools:
+                spools[name] = open(os.path.join(spool_path, f"{name}.pkl"), "wb")
+            pickle.dump((chunk_id, doc), spools[name], protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in spools.values():
+            f.close()
 
-def load_vector_store():
+    try:
+        if not seen:
+            return None, seen
+        shards_path = os.path.join(index_path, SHARDS_DIR)
+        if _read_manifest(index_path, index_config) == seen:
+            stores = {name: _load_index(os.path.join(shards_path, name), embeddings, mmap=True) for name in shards}
+        else:
+            stores = {}
+            for name, count in shards.items():
+                batches = _embedded_batches(os.path.join(spool_path, f"{name}.pkl"), embeddings, batch_size)
+                shard_path = os.path.join(shards_path, name)
+                build_store_from_batches(batches, embeddings, index_config["index_type"], count).save_local(
+                    shard_path, INDEX_NAME
+                )
+                stores[name] = _load_index(shard_path, embeddings, mmap=True)
+            _write_manifest(index_path, seen, index_config)
+    finally:
+        for name in spools:
+            os.remove(os.path.join(spool_path, f"{name}.pkl"))
+
+    if index_config["shard_by"] is None:
+        return stores[DEFAULT_SHARD], seen
+    return ShardedVectorStore(stores, embeddings), seen
+
+
+def _iter_spool(path):
+    # فایل spool توسط همین ماژول نوشته شده است
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _embedded_batches(spool_file, embeddings, batch_size):
+    """(docs, ids, vectors) batches of a shard's spooled chunks."""
+    for batch in iter_batches(_iter_spool(spool_file), batch_size):
+        docs = [doc for _, doc in batch]
+        yield docs, [chunk_id for chunk_id, _ in batch], embeddings.embed_documents([doc.page_content for doc in docs])
+
+
+@traced("load_vector_store")
+def load_vector_store(directory_path=None, index_path=INDEX_PATH, max_workers=None, batch_size=EMBED_BATCH_SIZE,
+                      index_type=INDEX_TYPE, shard_by=SHARD_BY):
+    """
+    Load the knowledge base from its on-disk FAISS index.
+
+    Chunks are identified by a hash of their source and content, so on restart
+    only chunks that were added or changed since the last run are embedded.
+    When nothing changed the saved index is memory-mapped as is. The returned store
+    carries a corpus_version fingerprint of its chunks and a lexical_index (BM25
+    over the same chunks, see lexical_index.hybrid_search). Documents are
+    streamed from file_processor.iter_document_chunks and embedded in batches
+    of batch_size, so the whole corpus is never held in memory at once.
+
+    index_type selects a compressed/approximate index (see vector_index.INDEX_TYPES),
+    and shard_by splits the corpus into one index per value of that metadata key
+    (falling back to the top-level folder of each source) searched in parallel.
+    """
     try:
         # استفاده از یک مدل embedding ساده
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
-        
-        # ایجاد یک پایگاه دانش ساده (برای تست)
-        # در عمل، باید داده‌های واقعی را اینجا بارگذاری کنید
-        texts = ["این یک متن نمونه برای تست است.", "پایگاه دانش برای پاسخ به سؤالات."]
-        vector_store = FAISS.from_texts(texts, embeddings)
-        
+        embeddings = get_embeddings(EMBEDDING_MODEL)
+
+        if directory_path is None:
+            chunks = [Document(page_content=text, metadata={"source": "sample"}) for text in SAMPLE_TEXTS]
+        else:
+            chunks = iter_document_chunks(directory_path, max_workers=max_workers)
+
+        # ایندکس BM25 برای جستجوی واژگانی (کد و نام دروس) همزمان با ورود اسناد ساخته می‌شود
+        lexical = BM25Index()
+        index_config = {"index_type": index_type, "shard_by": shard_by}
+        if index_config == DEFAULT_INDEX_CONFIG:
+            vector_store, seen = _load_flat_store(chunks, embeddings, index_path, batch_size, lexical)
+        else:
+            vector_store, seen = _load_sharded_store(chunks, embeddings, index_path, batch_size, index_config, lexical)
+
+        if vector_store is None:
+            raise ValueError(f"No PDF or DOCX files found in path: {directory_path}")
+        embeddings.save()
+
+        vector_store.corpus_version = _corpus_version(seen)
+        vector_store.lexical_index = lexical
+
         return vector_store
     except Exception as e:
         print(f"خطا در بارگذاری پایگاه دانش: {str(e)}")
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,153 @@
+"""
+BM25 inverted index over knowledge-base chunks with Persian-aware normalization,
+and hybrid retrieval fusing it with the vector store.
+
+Normalization maps Arabic yeh/kaf to their Persian forms, folds Arabic-Indic and
+Persian digits to ASCII, drops diacritics, tatweel and ZWNJ (so "می‌خواهم" and
+"میخواهم" match) and glues course codes such as "CS 105" / "cs-105" into one
+token (across a space only when the letters are upper case, so "exam in 2023"
+stays three words). Queries naming a course code that occurs in the indexed
+chunks are answered from the BM25 index alone, without calling the embedder.
+"""
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+_CHAR_MAP = str.maketrans({
+    "\u064a": "\u06cc",  # Arabic yeh -> Persian yeh
+    "\u0649": "\u06cc",  # alef maksura -> Persian yeh
+    "\u0643": "\u06a9",  # Arabic kaf -> Persian kaf
+    "\u0629": "\u0647",  # teh marbuta -> heh
+    "\u200c": None,       # ZWNJ
+    "\u200f": None,       # RLM
+    "\u0640": None,       # tatweel
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic-Indic digits
+    **{chr(0x06f0 + i): str(i) for i in range(10)},  # Persian digits
+})
+_DIACRITICS = re.compile("[\u064b-\u0652\u0670]")
+_CODE_JOIN_SPACE = re.compile(r"\b([A-Z]{2,5}) (\d{2,4})\b")
+_CODE_JOIN = re.compile(r"\b([a-z]{2,5})[\-_](\d{2,4})\b")
+_TOKEN = re.compile(r"\w+")
+# course codes: 2-5 letters followed by 2-4 digits (cs105) or 7-digit numeric codes (1511023);
+# years and dates (1402, 14020715) are not codes
+CODE_PATTERN = re.compile(r"^(?:[a-z]{2,5}\d{2,4}|\d{7})$")
+
+
+def normalize(text):
+    text = _CODE_JOIN_SPACE.sub(r"\1\2", _DIACRITICS.sub("", text.translate(_CHAR_MAP))).lower()
+    return _CODE_JOIN.sub(r"\1\2", text)
+
+
+def tokenize(text):
+    return _TOKEN.findall(normalize(text))
+
+
+def code_tokens(query):
+    """Course-code tokens in a query."""
+    return [token for token in tokenize(query) if CODE_PATTERN.match(token)]
+
+
+def doc_key(doc):
+    return doc.metadata.get("source", ""), doc.page_content
+
+
+class BM25Index:
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.docs = []
+        self._lengths = []
+        self._postings = defaultdict(list)
+        self._arrays = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc):
+        doc_index = len(self.docs)
+        self.docs.append(doc)
+        counts = Counter(tokenize(doc.page_content))
+        self._lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            self._postings[term].append((doc_index, tf))
+        self._arrays = None
+
+    def finalize(self):
+        """
+        Precompute the per-posting BM25 weights and return them (term -> (doc ids, weights)).
+
+        Runs on the first search after documents were added; serve.py calls it before
+        forking so the workers share one copy.
+        """
+        with self._lock:
+            if self._arrays is None:
+                self._arrays = self._compute_arrays()
+            return self._arrays
+
+    def _compute_arrays(self):
+        lengths = np.asarray(self._lengths, dtype=np.float32)
+        avg_length = lengths.mean() if len(lengths) else 0.0
+        norms = self.k1 * (1 - self.b + self.b * lengths / max(avg_length, 1e-9))
+        arrays = {}
+        for term, postings in self._postings.items():
+            ids = np.fromiter((p[0] for p in postings), dtype=np.int64, count=len(postings))
+            tfs = np.fromiter((p[1] for p in postings), dtype=np.float32, count=len(postings))
+            idf = math.log(1 + (len(self.docs) - len(ids) + 0.5) / (len(ids) + 0.5))
+            arrays[term] = (ids, idf * tfs * (self.k1 + 1) / (tfs + norms[ids]))
+        return arrays
+
+    def has_term(self, term):
+        """Whether any indexed chunk contains the (normalized) term."""
+        return term in self._postings
+
+    def search_with_scores(self, query, k=4):
+        """Top-k (doc, score) pairs for a query; documents without any query term are not returned."""
+        arrays = self._arrays if self._arrays is not None else self.finalize()
+        terms = [term for term in set(tokenize(query)) if term in arrays]
+        if not terms:
+            return []
+
+        scores = {}
+        for term in terms:
+            ids, weights = arrays[term]
+            for doc_index, weight in zip(ids.tolist(), weights.tolist()):
+                scores[doc_index] = scores.get(doc_index, 0.0) + weight
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.docs[doc_index], score) for doc_index, score in best]
+
+    def search(self, query, k=4):
+        return [doc for doc, _ in self.search_with_scores(query, k)]
+
+
+def hybrid_search(query, vector_store, lexical_index, k=4, candidates=20, query_vector=None):
+    """
+    Fuse BM25 and vector results with reciprocal rank fusion.
+
+    Queries naming a course code that occurs in the index are answered from BM25
+    alone and skip the embedder; an unknown code falls back to hybrid search.
+    query_vector, if given, is the precomputed embedding of query (batched retrieval).
+    """
+    if any(lexical_index.has_term(code) for code in code_tokens(query)):
+        return lexical_index.search(query, k)
+    lexical = lexical_index.search(query, candidates)
+
+    if query_vector is not None:
+        vector = vector_store.similarity_search_by_vector(query_vector, k=candidates)
+    else:
+        vector = vector_store.similarity_search(query, k=candidates)
+    fused = {}
+    for results in (lexical, vector):
+        for rank, doc in enumerate(results):
+            key = doc_key(doc)
+            score, _ = fused.get(key, (0.0, doc))
+            fused[key] = (score + 1 / (RRF_K + rank + 1), doc)
+    ranked = sorted(fused.values(), key=lambda item: item[0], reverse=True)
+    return [doc for _, doc in ranked[:k]]
@@ -1,28 +1,159 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import time
+from threading import Thread
 
-def get_llm():
-    model_name = "HooshvareLab/gpt2-fa"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(model_name)
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from inference_backends import supports_kv_reuse
+from resources import GENERATION_CONFIG, MODEL_NAME, get_causal_lm, get_generation_server, get_prefix_cache
+from telemetry import span
+
+
+class _StopWhen(StoppingCriteria):
+    """Stop generation as soon as a callable (e.g. job.should_stop) returns True."""
+
+    def __init__(self, should_stop):
+        self.should_stop = should_stop
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), bool(self.should_stop()), dtype=torch.bool, device=input_ids.device)
+
+
+# sampling of get_llm's custom_generate
+CONNECTOR_SAMPLING = {"temperature": 0.7, "repetition_penalty": 1.1}
+# sampling of the app's text-generation pipeline: the model's own generation config
+PIPELINE_SAMPLING = {}
+
+
+def _generation_kwargs(kwargs, sampling=CONNECTOR_SAMPLING):
+    # Apply parameters with defaults
+    generation_kwargs = {
+        "max_new_tokens": kwargs.get("max_new_tokens", 150),
+        "do_sample": True,
+        "pad_token_id": GENERATION_CONFIG["pad_token_id"],
+    }
+    for name in ("temperature", "repetition_penalty"):
+        value = kwargs.get(name, sampling.get(name))
+        if value is not None:
+            generation_kwargs[name] = value
+    # stop: callable checked after every token, used to cancel background jobs
+    if kwargs.get("stop") is not None:
+        generation_kwargs["stopping_criteria"] = StoppingCriteriaList([_StopWhen(kwargs["stop"])])
+    return generation_kwargs
+
+
+def _prepare_inputs(tokenizer, model, prompt):
+    """
+    Tokenize a prompt for model.generate.
+
+    A prompt given as a list of segments goes through the shared PrefixKVCache, so the
+    KV states of segments already seen in earlier prompts are reused instead of recomputed.
+    Backends that cannot take a pre-filled cache (onnx) get the joined text instead.
+    """
+    if not isinstance(prompt, str) and not supports_kv_reuse(model):
+        prompt = "".join(prompt)
+    with span("tokenization", prefix_cache=not isinstance(prompt, str)) as s:
+        if isinstance(prompt, str):
+            inputs = tokenizer(prompt, return_tensors="pt")
+            inputs = {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}
+        else:
+            inputs = get_prefix_cache(MODEL_NAME).prepare(prompt)
+        s.set(prompt_tokens=inputs["input_ids"].shape[1])
+    return inputs
+
+
+def get_llm(batched=False):
+    """
+    Return a `custom_generate(prompt, **kwargs) -> str` function for the shared GPT-2.
+
+    The prompt is either a string or a list of segments (see _prepare_inputs).
+    With batched=True the prompt is queued on the process-wide GenerationServer and
+    generated together with concurrent prompts from other sessions.
+    """
+    if batched:
+        server = get_generation_server(MODEL_NAME)
+
+        def batched_generate(prompt, **kwargs):
+            # a shared batch cannot be stopped for one caller
+            kwargs.pop("stop", None)
+            if not isinstance(prompt, str):
+                prompt = "".join(prompt)
+            with span("generation", batched=True):
+                return server.generate(prompt, **kwargs)
+
+        return batched_generate
+
+    tokenizer, model = get_causal_lm(MODEL_NAME)
 
     def custom_generate(prompt, **kwargs):
-        # Apply parameters with defaults
-        max_tokens = kwargs.get("max_new_tokens", 150) if "max_new_tokens" in kwargs else 150
-        temperature = kwargs.get("temperature", 0.7)
-        
         # Tokenize input
-        inputs = tokenizer(prompt, return_tensors="pt")
+        inputs = _prepare_inputs(tokenizer, model, prompt)
         
         # Generate text
-        outputs = model.generate(
-            inputs["input_ids"], 
-            max_new_tokens=max_tokens,
-            do_sample=True,
-            temperature=temperature,
-            repetition_penalty=1.1
-        )
+        with span("generation") as s:
+            started = time.perf_counter()
+            outputs = model.generate(
+                **inputs,
+                **_generation_kwargs(kwargs)
+            )
+            new_tokens = outputs.shape[1] - inputs["input_ids"].shape[1]
+            s.set(new_tokens=new_tokens, tokens_per_sec=new_tokens / (time.perf_counter() - started))
         
         # Decode output and return as plain string
-        return tokenizer.decode(outputs[0], skip_special_tokens=True)
+        with span("decoding"):
+            return tokenizer.decode(outputs[0], skip_special_tokens=True)
+
+    return custom_generate
+
+
+def stream_generate(prompt, **kwargs):
+    """
+    Generate a continuation of prompt and yield the new text piece by piece as it is decoded.
+
+    Accepts the same prompt types and keyword arguments as the function returned by
+    get_llm, including stop=callable to end generation early. The prompt itself is
+    not part of the output. Sampling follows the chat pipeline this path replaced
+    (PIPELINE_SAMPLING) unless temperature/repetition_penalty are passed. An error
+    in generate is raised here, in the consumer.
+    """
+    tokenizer, model = get_causal_lm(MODEL_NAME)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    inputs = _prepare_inputs(tokenizer, model, prompt)
+    errors = []
+    outputs = []
+
+    def generate():
+        try:
+            outputs.append(model.generate(**inputs, streamer=streamer, **_generation_kwargs(kwargs, PIPELINE_SAMPLING)))
+        except Exception as e:
+            errors.append(e)
+            # unblock the consumer; the error is re-raised there
+            streamer.end()
 
-    return custom_generate
\ No newline at end of file
+    thread = Thread(target=generate, daemon=True)
+    with span("generation", streaming=True) as s:
+        started = time.perf_counter()
+        first_piece_at = None
+        pieces = 0
+        thread.start()
+        try:
+            for text in streamer:
+                if text:
+                    if pieces == 0:
+                        first_piece_at = time.perf_counter()
+                        s.set(time_to_first_piece_ms=(first_piece_at - started) * 1000)
+                    pieces += 1
+                    yield text
+        finally:
+            thread.join()
+            finished = time.perf_counter()
+            s.set(pieces=pieces)
+            if outputs:
+                new_tokens = outputs[0].shape[1] - inputs["input_ids"].shape[1]
+                s.set(new_tokens=new_tokens, tokens_per_sec=new_tokens / (finished - started))
+                if first_piece_at is not None:
+                    # decode phase: everything after the first piece (prefill and first tokens excluded)
+                    decode_seconds = finished - first_piece_at
+                    s.set(decode_ms=decode_seconds * 1000,
+                          decode_tokens_per_sec=max(new_tokens - 1, 0) / max(decode_seconds, 1e-9))
+        if errors:
+            raise errors[0]
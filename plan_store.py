@@ -0,0 +1,201 @@
+"""
+Persistent weekly-plan store on SQLite (WAL mode).
+
+Plans are stored per student with their week number, topic and the request that
+produced them. A student has at most one plan per week and per request; there are
+unique indexes on (student, week) and (student, request) and an index on
+(topic, week). Looking up a plan for a request that was already answered is a
+single indexed query, and the plans of recently active students are also kept in
+an in-process LRU cache, so repeated requests return without touching the model.
+
+WAL lets the Streamlit workers, the batch CLI and readers use the same database
+file concurrently. New weeks are assigned inside one write transaction, so
+concurrent writers never give two plans the same week, and listings (weeks,
+next_week, by_topic) always read the database, so they include plans written by
+other processes; the cache only serves get().
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from lexical_index import normalize, tokenize
+
+PLAN_DB_PATH = "weekly_plans.sqlite3"
+RECENT_STUDENTS = 256
+TOPIC_WORDS = 3
+# words of a plan request that say nothing about its topic
+PLAN_STOP_WORDS = frozenset({
+    "برنامه", "هفتگی", "ریزی", "برنامهریزی", "برای", "یک", "من", "را", "به", "و", "در", "از", "با",
+    "میخواهم", "میخوام", "خواهم", "لطفا", "مطالعه", "درس", "هفته", "weekly", "plan", "for", "a", "the",
+})
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    student_id TEXT NOT NULL,
+    week INTEGER NOT NULL,
+    topic TEXT NOT NULL,
+    request TEXT NOT NULL,
+    request_key TEXT NOT NULL,
+    plan TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS plans_student_request ON plans (student_id, request_key);
+CREATE UNIQUE INDEX IF NOT EXISTS plans_student_week ON plans (student_id, week);
+CREATE INDEX IF NOT EXISTS plans_topic_week ON plans (topic, week);
+"""
+# week range bounds used when first_week/last_week are not given
+_MIN_WEEK, _MAX_WEEK = -2 ** 31, 2 ** 31
+_COLUMNS = "student_id, week, topic, request, plan, created_at"
+
+
+def request_key(request):
+    """Key of a plan request; spelling variants (yeh/kaf, ZWNJ, spacing) map to the same key."""
+    return hashlib.sha1(" ".join(tokenize(request)).encode("utf-8")).hexdigest()
+
+
+def plan_topic(request):
+    """Short topic label of a plan request, e.g. "ریاضی" for "یک برنامه هفتگی برای مطالعه ریاضی"."""
+    words = [word for word in tokenize(request) if word not in PLAN_STOP_WORDS]
+    return " ".join(words[:TOPIC_WORDS]) or normalize(request).strip()
+
+
+def _row(values):
+    return dict(zip(("student_id", "week", "topic", "request", "plan", "created_at"), values))
+
+
+class PlanStore:
+    def __init__(self, path=PLAN_DB_PATH, recent_students=RECENT_STUDENTS):
+        self.path = path
+        self.recent_students = recent_students
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # student_id -> {request_key: row}, least recently used first
+        self._recent = OrderedDict()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        """One connection per thread (sqlite3 connections must not be shared between threads)."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # autocommit; write transactions are opened explicitly with BEGIN IMMEDIATE
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _cache(self, student_id, plans):
+        with self._lock:
+            self._recent[student_id] = plans
+            self._recent.move_to_end(student_id)
+            while len(self._recent) > self.recent_students:
+                self._recent.popitem(last=False)
+
+    def _query_plans(self, student_id, first_week=None, last_week=None):
+        """(request key, row) pairs of a student's plans in a week range, read from the database."""
+        rows = self._connection().execute(
+            f"SELECT request_key, {_COLUMNS} FROM plans WHERE student_id = ? AND week BETWEEN ? AND ? ORDER BY week",
+            (student_id, _MIN_WEEK if first_week is None else first_week,
+             _MAX_WEEK if last_week is None else last_week),
+        ).fetchall()
+        return [(row[0], _row(row[1:])) for row in rows]
+
+    def _student_plans(self, student_id):
+        """All plans of a student keyed by request key, through the recent-student cache."""
+        with self._lock:
+            plans = self._recent.get(student_id)
+            if plans is not None:
+                self._recent.move_to_end(student_id)
+                return plans
+        plans = dict(self._query_plans(student_id))
+        self._cache(student_id, plans)
+        return plans
+
+    def get(self, student_id, request):
+        """The stored plan for this student and request (as a dict), or None."""
+        key = request_key(request)
+        plans = self._student_plans(student_id)
+        row = plans.get(key)
+        if row is None:
+            # the plan may have been written by another process (serve.py worker, batch CLI)
+            values = self._connection().execute(
+                f"SELECT {_COLUMNS} FROM plans WHERE student_id = ? AND request_key = ?", (student_id, key)
+            ).fetchone()
+            if values is not None:
+                row = plans[key] = _row(values)
+        return row
+
+    def next_week(self, student_id, connection=None):
+        """The week after the student's last planned week (1 for a new student)."""
+        return (connection or self._connection()).execute(
+            "SELECT COALESCE(MAX(week), 0) + 1 FROM plans WHERE student_id = ?", (student_id,)
+        ).fetchone()[0]
+
+    def put(self, student_id, request, plan, week=None, topic=None):
+        """
+        Store the plan for a request and return its row.
+
+        Without a week, a request the student already has keeps its week and a new one
+        gets the next free week. A given week replaces the student's plan for that week.
+        """
+        key = request_key(request)
+        row = {
+            "student_id": student_id,
+            "week": week,
+            "topic": topic or plan_topic(request),
+            "request": request,
+            "plan": plan,
+            "created_at": time.time(),
+        }
+        connection = self._connection()
+        # the write lock is taken before reading the weeks, so no other writer can take the same week
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if week is None:
+                existing = connection.execute(
+                    "SELECT week FROM plans WHERE student_id = ? AND request_key = ?", (student_id, key)
+                ).fetchone()
+                row["week"] = existing[0] if existing else self.next_week(student_id, connection)
+            row["week"] = int(row["week"])
+            connection.execute(
+                f"INSERT OR REPLACE INTO plans (request_key, {_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, *row.values()),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        # a replaced week may have removed another cached plan; reload the student on next use
+        with self._lock:
+            self._recent.pop(student_id, None)
+        return row
+
+    def weeks(self, student_id, first_week=None, last_week=None):
+        """A student's plans ordered by week, optionally limited to first_week..last_week (inclusive)."""
+        plans = self._query_plans(student_id, first_week, last_week)
+        if first_week is None and last_week is None:
+            self._cache(student_id, dict(plans))
+        return [row for _, row in plans]
+
+    def by_topic(self, topic, first_week=None, last_week=None, limit=100):
+        """Plans of all students on a topic, optionally within a week range."""
+        rows = self._connection().execute(
+            f"SELECT {_COLUMNS} FROM plans WHERE topic = ? AND week BETWEEN ? AND ? ORDER BY week LIMIT ?",
+            (topic, _MIN_WEEK if first_week is None else first_week,
+             _MAX_WEEK if last_week is None else last_week, limit),
+        ).fetchall()
+        return [_row(row) for row in rows]
+
+    def delete(self, student_id, request):
+        key = request_key(request)
+        self._connection().execute("DELETE FROM plans WHERE student_id = ? AND request_key = ?", (student_id, key))
+        with self._lock:
+            plans = self._recent.get(student_id)
+            if plans is not None:
+                plans.pop(key, None)
@@ -1,22 +1,50 @@
-from transformers import pipeline
+from transformers import Pipeline
+from llm_connector import get_llm
+from resources import get_plan_store
+from telemetry import traced
 
-def create_weekly_plan(prompt, model=None):
+# ثابت نگه داشتن این پیشوند باعث می‌شود حالت KV آن بین درخواست‌ها دوباره استفاده شود
+WEEKLY_PLAN_PREFIX = "Weekly program for:"
+DEFAULT_STUDENT = "anonymous"
+
+def is_plan_request(text):
+    """Whether a chat message asks for a weekly plan rather than a knowledge-base answer."""
+    return "برنامه هفتگی" in text.lower() or "برنامه‌ریزی" in text.lower()
+
+
+@traced("weekly_plan")
+def create_weekly_plan(prompt, model=None, student_id=DEFAULT_STUDENT, week=None, store=None, stop=None):
+    """
+    Weekly plan for a request as (plan text, week number).
+
+    Plans are kept per student in the plan store: a request the student already made
+    returns the stored plan without generating, and a new plan gets the given week or
+    the student's next free week. When no plan could be generated nothing is stored
+    and the week is None.
+
+    stop is an optional callable (e.g. job.should_stop) that ends generation early;
+    a plan generated after stop() became true is returned but not stored.
+    """
     try:
+        if store is None:
+            store = get_plan_store()
+        stored = store.get(student_id, prompt)
+        if stored is not None and week in (None, stored["week"]):
+            return stored["plan"], stored["week"]
+
         if model is None:
-            model = pipeline(
-                "text-generation",
-                model="HooshvareLab/gpt2-fa",
-                tokenizer="HooshvareLab/gpt2-fa",
-                max_length=512,
-                pad_token_id=5
-            )
+            model = get_llm()
 
-        input_text = f"Weekly program for: {prompt}\n"
-        output = model(
-            input_text,
-            max_new_tokens=200,
-            do_sample=True
-        )
+        segments = [WEEKLY_PLAN_PREFIX, f" {prompt}\n"]
+        input_text = "".join(segments)
+        if isinstance(model, Pipeline):
+            output = model(
+                input_text,
+                max_new_tokens=200,
+                do_sample=True
+            )
+        else:
+            output = model(segments, max_new_tokens=200, stop=stop)
         
         if isinstance(output, list) and len(output) > 0 and isinstance(output[0], dict):
             response_text = output[0].get("generated_text", "")
@@ -26,10 +54,10 @@ def create_weekly_plan(prompt, model=None):
         response_text = response_text.replace(input_text, "").strip()
         
         if not response_text:
-            response_text = "متأسفانه برنامه‌ای تولید نشد. لطفاً دوباره تلاش کنید."
-        
-        week_num = len(prompt) % 10 
+            return "متأسفانه برنامه‌ای تولید نشد. لطفاً دوباره تلاش کنید.", None
+        if stop is not None and stop():
+            return response_text, None
 
-        return response_text, week_num
+        return response_text, store.put(student_id, prompt, response_text, week=week)["week"]
     except Exception as e:
         return f"خطا در تولید برنامه هفتگی: {str(e)}", "error"
\ No newline at end of file
@@ -0,0 +1,144 @@
+"""
+KV-cache reuse for prompts that share a prefix.
+
+A prompt is passed as a list of text segments (e.g. the fixed instruction,
+then the conversation history, question and context). Segments are
+tokenized on their own, so a segment always maps to the same token ids no matter
+what follows it. A later prompt that starts with the same segments only has to
+prefill the new ones.
+
+The GPT-2 past_key_values are stored at segment boundaries that are actually
+shared: the last segment is the request-specific tail and is never stored, and
+any other boundary is stored only the second time its prefix is seen (a bounded
+set of prefix hashes remembers the first sighting). Unique prompts therefore do
+not evict useful entries. Entries are evicted least-recently-used once their total
+size exceeds max_bytes.
+"""
+import copy
+import threading
+from collections import OrderedDict
+
+import torch
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+SEEN_PREFIXES = 4096
+
+
+def _cache_nbytes(past):
+    layers = getattr(past, "layers", None)
+    if layers is not None:
+        tensors = [t for layer in layers for t in (layer.keys, layer.values) if t is not None]
+    else:
+        tensors = list(past.key_cache) + list(past.value_cache)
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class PrefixKVCache:
+    def __init__(self, tokenizer, model, max_bytes=DEFAULT_MAX_BYTES, seen_prefixes=SEEN_PREFIXES):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_bytes = max_bytes
+        self.seen_prefixes = seen_prefixes
+        self._entries = OrderedDict()
+        # hashes of prefixes seen once, least recently seen first
+        self._seen = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _tokenize(self, segments):
+        ids, boundaries = [], []
+        for segment in segments:
+            if not segment:
+                continue
+            ids.extend(self.tokenizer(segment, add_special_tokens=False)["input_ids"])
+            boundaries.append(len(ids))
+        return ids, boundaries
+
+    def _lookup(self, ids, boundaries):
+        with self._lock:
+            for boundary in reversed(boundaries):
+                key = tuple(ids[:boundary])
+                past = self._entries.get(key)
+                if past is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return boundary, copy.deepcopy(past)
+            self.misses += 1
+        return 0, None
+
+    def _admit(self, key):
+        """Whether the KV state of a prefix should be stored: only from its second sighting on."""
+        digest = hash(key)
+        with self._lock:
+            if key in self._entries:
+                return False
+            if digest in self._seen:
+                del self._seen[digest]
+                return True
+            self._seen[digest] = None
+            while len(self._seen) > self.seen_prefixes:
+                self._seen.popitem(last=False)
+        return False
+
+    def _store(self, key, past):
+        size = _cache_nbytes(past)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = past
+            self._sizes[key] = size
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+
+    def prepare(self, segments):
+        """
+        Return generate() inputs for the concatenated segments with a pre-filled KV cache.
+
+        The result holds input_ids, attention_mask and past_key_values covering every
+        token except the last one, so generate() only runs the final prompt token.
+        """
+        ids, boundaries = self._tokenize(segments)
+        if not ids:
+            raise ValueError("Prompt is empty")
+
+        cached, past = self._lookup(ids, boundaries)
+        with torch.no_grad():
+            for boundary in boundaries:
+                if boundary <= cached:
+                    continue
+                outputs = self.model(
+                    input_ids=torch.tensor([ids[cached:boundary]]),
+                    past_key_values=past,
+                    use_cache=True
+                )
+                past = outputs.past_key_values
+                cached = boundary
+                if boundary != boundaries[-1] and self._admit(tuple(ids[:boundary])):
+                    self._store(tuple(ids[:boundary]), copy.deepcopy(past))
+
+        past.crop(-1)
+        input_ids = torch.tensor([ids])
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "past_key_values": past,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._seen.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,196 @@
+"""
+Process-wide registry of heavy resources (models, tokenizers, embeddings, vector store).
+
+Streamlit re-executes app.py on every interaction, but imported modules survive
+between reruns, so keeping the instances here means every rerun, session and
+module shares one copy per process. Instances are created lazily on first use
+and keyed by kind, name and config.
+"""
+import gc
+import os
+import threading
+
+MODEL_NAME = "HooshvareLab/gpt2-fa"
+GENERATION_CONFIG = {"max_length": 512, "pad_token_id": 5}
+# eager, int8, compile or onnx (see inference_backends.py)
+LLM_BACKEND = os.environ.get("ADVISOR_LLM_BACKEND", "eager")
+LLM_NUM_THREADS = int(os.environ.get("ADVISOR_NUM_THREADS", "0")) or None
+EMBEDDING_CACHE_DIR = "embedding_cache"
+EMBEDDING_BATCH_SIZE = 64
+
+_lock = threading.RLock()
+_resources = {}
+_factories = {}
+
+
+def register_factory(kind, factory):
+    """Register `factory(name, **config)` as the constructor for a resource kind."""
+    _factories[kind] = factory
+
+
+def _key(kind, name, config):
+    return (kind, name, tuple(sorted(config.items())))
+
+
+def get_resource(kind, name, **config):
+    """Return the shared instance for (kind, name, config), creating it on first use."""
+    key = _key(kind, name, config)
+    resource = _resources.get(key)
+    if resource is not None:
+        return resource
+
+    with _lock:
+        resource = _resources.get(key)
+        if resource is None:
+            if kind not in _factories:
+                raise KeyError(f"No factory registered for resource kind: {kind}")
+            resource = _factories[kind](name, **config)
+            # failed loads are not cached so the next call can retry
+            if resource is not None:
+                _resources[key] = resource
+    return resource
+
+
+def evict(kind=None, name=None):
+    """Drop cached instances matching kind/name (all of them by default) and free their memory."""
+    with _lock:
+        keys = [
+            key for key in _resources
+            if (kind is None or key[0] == kind) and (name is None or key[1] == name)
+        ]
+        for key in keys:
+            close = getattr(_resources.pop(key), "close", None)
+            if callable(close):
+                close()
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+    return len(keys)
+
+
+def loaded_resources():
+    """List the (kind, name, config) keys currently held in memory."""
+    with _lock:
+        return list(_resources)
+
+
+def _load_causal_lm(name, backend="eager", num_threads=None):
+    from inference_backends import load_causal_lm
+
+    return load_causal_lm(name, backend=backend, num_threads=num_threads)
+
+
+def _load_generation_server(name, **config):
+    from generation_server import GenerationServer
+
+    tokenizer, model = get_causal_lm(name)
+    return GenerationServer(tokenizer, model, **config)
+
+
+def _load_prefix_cache(name, **config):
+    from prefix_cache import PrefixKVCache
+
+    tokenizer, model = get_causal_lm(name)
+    return PrefixKVCache(tokenizer, model, **config)
+
+
+def _load_response_cache(name, **config):
+    from response_cache import SemanticResponseCache
+
+    return SemanticResponseCache(get_embeddings(name), **config)
+
+
+def _load_embeddings(name, batch_size=EMBEDDING_BATCH_SIZE):
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from embedding_cache import CachedEmbeddings
+
+    embeddings = HuggingFaceEmbeddings(model_name=name, encode_kwargs={"batch_size": batch_size})
+    cache_path = os.path.join(EMBEDDING_CACHE_DIR, name.replace("/", "__"))
+    return CachedEmbeddings(embeddings, cache_path=cache_path, batch_size=batch_size)
+
+
+def _load_job_manager(name, **config):
+    from job_queue import JobManager
+
+    return JobManager(**config)
+
+
+def _load_plan_store(name, **config):
+    from plan_store import PlanStore
+
+    return PlanStore(name, **config)
+
+
+def _load_vector_store(name, directory_path=None, **config):
+    from knowledge_base import load_vector_store
+
+    return load_vector_store(directory_path=directory_path, index_path=name, **config)
+
+
+register_factory("causal_lm", _load_causal_lm)
+register_factory("generation_server", _load_generation_server)
+register_factory("prefix_cache", _load_prefix_cache)
+register_factory("response_cache", _load_response_cache)
+register_factory("embeddings", _load_embeddings)
+register_factory("vector_store", _load_vector_store)
+register_factory("job_manager", _load_job_manager)
+register_factory("plan_store", _load_plan_store)
+
+
+def get_causal_lm(model_name=MODEL_NAME, backend=None, num_threads=None):
+    """Shared (tokenizer, model) pair for a causal language model on the configured inference backend."""
+    return get_resource(
+        "causal_lm", model_name, backend=backend or LLM_BACKEND, num_threads=num_threads or LLM_NUM_THREADS
+    )
+
+
+def get_generation_server(model_name=MODEL_NAME, **config):
+    """Shared micro-batching GenerationServer in front of get_causal_lm."""
+    return get_resource("generation_server", model_name, **config)
+
+
+def get_prefix_cache(model_name=MODEL_NAME, **config):
+    """Shared PrefixKVCache of past_key_values for common prompt prefixes."""
+    return get_resource("prefix_cache", model_name, **config)
+
+
+def get_embeddings(model_name, **config):
+    """Shared HuggingFace embeddings instance, wrapped in the on-disk embedding cache."""
+    return get_resource("embeddings", model_name, **config)
+
+
+def get_response_cache(**config):
+    """Shared SemanticResponseCache using the knowledge-base embedder."""
+    from knowledge_base import EMBEDDING_MODEL
+
+    return get_resource("response_cache", EMBEDDING_MODEL, **config)
+
+
+def get_job_manager(name="default", **config):
+    """Shared JobManager running generation and planning jobs in the background."""
+    return get_resource("job_manager", name, **config)
+
+
+def get_plan_store(path=None, **config):
+    """Shared PlanStore (SQLite) of generated weekly plans."""
+    from plan_store import PLAN_DB_PATH
+
+    return get_resource("plan_store", path or PLAN_DB_PATH, **config)
+
+
+def get_vector_store(directory_path=None, index_path=None, **config):
+    """Shared knowledge-base vector store for an index path (config: index_type, shard_by, ...)."""
+    from knowledge_base import INDEX_PATH
+
+    return get_resource("vector_store", index_path or INDEX_PATH, directory_path=directory_path, **config)
+
+
+def warm_up(model_name=MODEL_NAME, vector_store=True):
+    """Load the model (and optionally the vector store) ahead of the first request."""
+    get_causal_lm(model_name)
+    if vector_store:
+        get_vector_store()
@@ -0,0 +1,108 @@
+"""
+Semantic cache of answers to previously asked questions.
+
+Questions are embedded with the knowledge-base embedder and kept in a small
+inner-product FAISS index of normalized vectors, so a new question whose cosine
+similarity to a cached one is at least `threshold` gets the stored answer back
+without retrieval or generation. Entries expire after `ttl` seconds, the oldest
+ones are dropped beyond `max_entries`, and the whole cache is cleared when the
+knowledge base's corpus version changes.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class SemanticResponseCache:
+    def __init__(self, embeddings, threshold=DEFAULT_THRESHOLD, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._faiss = dependable_faiss_import()
+        self._index = None
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._corpus_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, question):
+        vector = np.asarray([self.embeddings.embed_query(question)], dtype=np.float32)
+        self._faiss.normalize_L2(vector)
+        return vector
+
+    def _remove(self, ids):
+        for entry_id in ids:
+            self._entries.pop(entry_id, None)
+        if ids:
+            self._index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def _check_version(self, corpus_version):
+        if corpus_version != self._corpus_version:
+            self._entries.clear()
+            if self._index is not None:
+                self._index.reset()
+            self._corpus_version = corpus_version
+
+    def _expire(self, now):
+        expired = [entry_id for entry_id, (_, _, created_at) in self._entries.items() if now - created_at > self.ttl]
+        self._remove(expired)
+
+    def lookup(self, question, corpus_version=None):
+        """Return the cached answer for a semantically equivalent question, or None."""
+        vector = self._embed(question)
+        with self._lock:
+            self._check_version(corpus_version)
+            if self._index is None or not self._entries:
+                self.misses += 1
+                return None
+
+            scores, ids = self._index.search(vector, 1)
+            entry_id = int(ids[0][0])
+            entry = self._entries.get(entry_id)
+            if entry is None or scores[0][0] < self.threshold:
+                self.misses += 1
+                return None
+            if time.time() - entry[2] > self.ttl:
+                self._remove([entry_id])
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return entry[1]
+
+    def add(self, question, answer, corpus_version=None):
+        vector = self._embed(question)
+        with self._lock:
+            self._check_version(corpus_version)
+            if self._index is None:
+                self._index = self._faiss.IndexIDMap2(self._faiss.IndexFlatIP(vector.shape[1]))
+
+            now = time.time()
+            self._expire(now)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.asarray([entry_id], dtype=np.int64))
+            self._entries[entry_id] = (question, answer, now)
+
+            if len(self._entries) > self.max_entries:
+                self._remove(list(self._entries)[:len(self._entries) - self.max_entries])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._index is not None:
+                self._index.reset()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
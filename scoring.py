@@ -0,0 +1,181 @@
+"""
+Bulk answer-scoring metrics for evaluation results.
+
+Every metric takes two equally long pandas Series (predictions and references)
+and returns a float NumPy array with one score per row. Token metrics tokenize
+each distinct text once, map tokens to integer ids and compute all per-row
+overlaps at once with np.intersect1d/np.bincount over (row, token) keys, so re-scoring a large
+results file takes seconds and never calls the model.
+
+    results_df = score(results_df, ["token_f1", "sql_match"])
+
+New metrics are added with @register_metric("name"). Metrics registered with
+uses_token_counts=True also take counts=token_counts(predictions, references); score()
+computes those once and passes them to every such metric.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+METRICS = {}
+# metrics taking counts=token_counts(...)
+TOKEN_COUNT_METRICS = set()
+DEFAULT_METRICS = ("relevance_score", "token_f1", "exact_match", "sql_match")
+
+STOP_WORDS = frozenset({
+    "the", "a", "an", "and", "or", "but", "is", "are", "was", "were",
+    "in", "on", "at", "to", "for", "with", "by", "about", "like", "from",
+})
+ERROR_RESPONSE = "ERROR"
+
+_TOKEN = re.compile(r"\w+")
+_SQL_START = re.compile(r"\bselect\b")
+_SQL_PUNCTUATION = re.compile(r"\s*([(),=<>!*+\-/])\s*")
+
+
+def register_metric(name, uses_token_counts=False):
+    """Decorator adding a metric(predictions, references) -> np.ndarray to METRICS."""
+    def decorator(fn):
+        METRICS[name] = fn
+        if uses_token_counts:
+            TOKEN_COUNT_METRICS.add(name)
+        return fn
+    return decorator
+
+
+def _text_tokens(texts):
+    """
+    Tokenize every distinct text once; returns (text id per input, per-text token
+    offsets, token ids) with each text's tokens unique and stop words removed.
+    """
+    text_ids, uniques = pd.factorize(texts.fillna("").astype(str))
+    vocab = {}
+    token_ids, lengths = [], []
+    for text in uniques:
+        tokens = set(_TOKEN.findall(text.lower())) - STOP_WORDS
+        token_ids.extend(vocab.setdefault(token, len(vocab)) for token in tokens)
+        lengths.append(len(tokens))
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    return text_ids, offsets, np.asarray(token_ids, dtype=np.int64)
+
+
+def _row_keys(text_ids, offsets, token_ids, vocab_size):
+    """Sorted int64 keys row * vocab_size + token id for the tokens of every row, and per-row counts."""
+    lengths = offsets[text_ids + 1] - offsets[text_ids]
+    rows = np.repeat(np.arange(len(text_ids), dtype=np.int64), lengths)
+    starts = np.repeat(offsets[text_ids] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    keys = rows * vocab_size + token_ids[starts + np.arange(len(rows))]
+    keys.sort()
+    return keys, lengths
+
+
+def token_counts(predictions, references):
+    """(shared, prediction, reference) unique-token counts per row."""
+    rows = len(predictions)
+    texts = pd.concat([pd.Series(predictions), pd.Series(references)], ignore_index=True)
+    text_ids, offsets, token_ids = _text_tokens(texts)
+    vocab_size = int(token_ids.max()) + 1 if len(token_ids) else 1
+    pred_keys, pred_counts = _row_keys(text_ids[:rows], offsets, token_ids, vocab_size)
+    ref_keys, ref_counts = _row_keys(text_ids[rows:], offsets, token_ids, vocab_size)
+    shared = np.intersect1d(pred_keys, ref_keys, assume_unique=True)
+    return np.bincount(shared // vocab_size, minlength=rows), pred_counts, ref_counts
+
+
+def _valid(predictions):
+    """Rows with an actual model response."""
+    predictions = pd.Series(predictions).reset_index(drop=True)
+    return (predictions.notna() & (predictions.astype(str) != ERROR_RESPONSE)).to_numpy()
+
+
+@register_metric("relevance_score", uses_token_counts=True)
+def token_overlap(predictions, references, counts=None):
+    """Share of the reference's tokens that appear in the prediction (token recall)."""
+    shared, _, ref_counts = counts or token_counts(predictions, references)
+    return np.where(ref_counts > 0, shared / np.maximum(ref_counts, 1), 0.0) * _valid(predictions)
+
+
+@register_metric("token_f1", uses_token_counts=True)
+def token_f1(predictions, references, counts=None):
+    shared, pred_counts, ref_counts = counts or token_counts(predictions, references)
+    total = pred_counts + ref_counts
+    return np.where(total > 0, 2 * shared / np.maximum(total, 1), 0.0) * _valid(predictions)
+
+
+def _normalized_match(predictions, references, normalize):
+    """1.0 where normalize(prediction) == normalize(reference); every distinct text is normalized once."""
+    rows = len(predictions)
+    texts = pd.concat([pd.Series(predictions), pd.Series(references)], ignore_index=True).fillna("").astype(str)
+    text_ids, uniques = pd.factorize(texts)
+    normalized_ids, _ = pd.factorize(pd.Series([normalize(text) for text in uniques], dtype=object))
+    ids = normalized_ids[text_ids] if len(text_ids) else text_ids
+    return (ids[:rows] == ids[rows:]).astype(np.float64)
+
+
+def normalize_text(text):
+    return " ".join(text.lower().split())
+
+
+@register_metric("exact_match")
+def exact_match(predictions, references):
+    return _normalized_match(predictions, references, normalize_text)
+
+
+def normalize_sql(text):
+    """
+    Canonical form of a SQL string: the part starting at the first SELECT, lowercased,
+    with unified quotes, no spacing around punctuation and no trailing semicolon.
+    """
+    text = text.lower()
+    match = _SQL_START.search(text)
+    if match:
+        text = text[match.start():]
+    text = text.split(";", 1)[0].replace('"', "'")
+    return " ".join(_SQL_PUNCTUATION.sub(r"\1", text).split())
+
+
+@register_metric("sql_match")
+def sql_match(predictions, references):
+    """Exact match of the normalized SQL in the prediction against the reference query."""
+    return _normalized_match(predictions, references, normalize_sql)
+
+
+@register_metric("embedding_cosine")
+def embedding_cosine(predictions, references, embeddings=None):
+    """Cosine similarity of prediction and reference embeddings (from the on-disk embedding cache)."""
+    if embeddings is None:
+        from knowledge_base import EMBEDDING_MODEL
+        from resources import get_embeddings
+
+        embeddings = get_embeddings(EMBEDDING_MODEL)
+    predictions = pd.Series(predictions).fillna("").astype(str).reset_index(drop=True)
+    references = pd.Series(references).fillna("").astype(str).reset_index(drop=True)
+    if len(predictions) == 0:
+        return np.zeros(0)
+
+    # every distinct text is embedded once
+    texts, inverse = np.unique(np.concatenate([predictions.to_numpy(), references.to_numpy()]), return_inverse=True)
+    vectors = np.asarray(embeddings.embed_documents(texts.tolist()), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    pred_vectors = vectors[inverse[:len(predictions)]]
+    ref_vectors = vectors[inverse[len(predictions):]]
+    if hasattr(embeddings, "save"):
+        embeddings.save()
+    return np.einsum("ij,ij->i", pred_vectors, ref_vectors) * _valid(predictions)
+
+
+def score(results_df, metrics=DEFAULT_METRICS, prediction="model_response", reference="gold_query"):
+    """Return a copy of results_df with one column per metric."""
+    unknown = [name for name in metrics if name not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)} (available: {', '.join(METRICS)})")
+    results_df = results_df.copy()
+    predictions, references = results_df[prediction], results_df[reference]
+    # token metrics share one tokenization
+    counts = token_counts(predictions, references) if TOKEN_COUNT_METRICS.intersection(metrics) else None
+    for name in metrics:
+        if name in TOKEN_COUNT_METRICS:
+            results_df[name] = METRICS[name](predictions, references, counts=counts)
+        else:
+            results_df[name] = METRICS[name](predictions, references)
+    return results_df
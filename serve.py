@@ -0,0 +1,185 @@
+"""
+Multi-process serving: N Streamlit workers sharing one copy of the model and index.
+
+    python serve.py --workers 4 --base-port 8501
+
+The supervisor loads the GPT-2 weights, the embedder and the FAISS index once
+(through resources.warm_up), builds the BM25 weights of the lexical index,
+freezes the garbage collector so the loaded objects are never written to again,
+and then forks one Streamlit server per port (base-port, base-port + 1, ...). Each worker imports the already-loaded
+resources module, so app.py finds the model and vector store in the registry
+and the weights stay shared copy-on-write with the supervisor; the FAISS index
+is memory-mapped from disk and shared through the page cache. A worker that
+exits is restarted from the supervisor, after a delay that doubles (up to
+RESTART_BACKOFF_MAX seconds) while it keeps exiting within STABLE_SECONDS of its start.
+
+With ADVISOR_METRICS_PORT set, the supervisor serves its own /metrics on that port
+and worker i serves its request metrics on ADVISOR_METRICS_PORT + 1 + i.
+
+Put a reverse proxy with sticky sessions (e.g. nginx ip_hash) in front of the
+ports; Streamlit sessions live in a single worker. Linux/macOS only (fork).
+"""
+import argparse
+import gc
+import os
+import signal
+import sys
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+RESTART_BACKOFF = 1.0
+RESTART_BACKOFF_MAX = 60.0
+STABLE_SECONDS = 30.0
+
+
+def preload(model_name=None):
+    """Load the shared resources in the supervisor, before any worker is forked."""
+    import resources
+
+    resources.warm_up(model_name or resources.MODEL_NAME)
+    # the BM25 weights are otherwise built lazily by every worker on its first search
+    lexical_index = getattr(resources.get_vector_store(), "lexical_index", None)
+    if lexical_index is not None:
+        lexical_index.finalize()
+    _, model = resources.get_causal_lm(model_name or resources.MODEL_NAME)
+    # no autograd state is ever written to the weights, so their pages stay shared
+    for parameter in getattr(model, "parameters", lambda: [])():
+        parameter.requires_grad_(False)
+    return resources.loaded_resources()
+
+
+def _metrics_port(index):
+    base = os.environ.get("ADVISOR_METRICS_PORT")
+    return int(base) + 1 + index if base else None
+
+
+def run_worker(port, num_threads, metrics_port=None):
+    """Body of a forked worker: run a Streamlit server for app.py on port."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    gc.enable()
+    import telemetry
+
+    telemetry.reset_after_fork(metrics_port)
+    if num_threads:
+        import torch
+
+        torch.set_num_threads(num_threads)
+    from streamlit.web import bootstrap
+
+    sys.argv = ["streamlit", "run", APP_PATH]
+    # same as `streamlit run --server.port ... --server.headless true`: bootstrap.run itself
+    # only installs config watchers, the options have to be loaded first
+    flag_options = {"server_port": port, "server_headless": True}
+    bootstrap.load_config_options(flag_options=flag_options)
+    bootstrap.run(APP_PATH, False, [], flag_options)
+
+
+def spawn(port, num_threads, metrics_port=None):
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            run_worker(port, num_threads, metrics_port)
+            status = 0
+        finally:
+            os._exit(status)
+    return pid
+
+
+def _memory_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def memory_report(pids):
+    """RSS and PSS (RSS with shared pages split between their users) per process, in MB (Linux)."""
+    return {
+        pid: {"rss_mb": (_memory_kb(pid, "Rss") or 0) / 1024, "pss_mb": (_memory_kb(pid, "Pss") or 0) / 1024}
+        for pid in pids
+    }
+
+
+def supervise(workers, base_port, num_threads=None, report_interval=0):
+    print("Loading model and knowledge base...")
+    for key in preload():
+        print(f"  loaded {key}")
+
+    # freeze everything loaded so far: the collector will not touch (and un-share) these objects
+    gc.disable()
+    gc.collect()
+    gc.freeze()
+
+    num_threads = num_threads or max(1, (os.cpu_count() or 1) // workers)
+    # pid -> worker index; per index: start time and consecutive quick exits
+    children = {}
+    started_at = {}
+    failures = dict.fromkeys(range(workers), 0)
+    # worker index -> monotonic time of its next start
+    restarts = {}
+
+    def start(i):
+        pid = spawn(base_port + i, num_threads, _metrics_port(i))
+        children[pid] = i
+        started_at[i] = time.monotonic()
+        metrics = f", metrics on port {_metrics_port(i)}" if _metrics_port(i) else ""
+        print(f"Worker on port {base_port + i} started (pid {pid}{metrics})")
+
+    for i in range(workers):
+        start(i)
+
+    def shutdown(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    last_report = time.monotonic()
+    while True:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid in children:
+            i = children.pop(pid)
+            now = time.monotonic()
+            failures[i] = failures[i] + 1 if now - started_at[i] < STABLE_SECONDS else 1
+            delay = min(RESTART_BACKOFF * 2 ** (failures[i] - 1), RESTART_BACKOFF_MAX)
+            restarts[i] = now + delay
+            print(f"Worker on port {base_port + i} exited with status {status}; restarting in {delay:.0f}s")
+        for i, due in list(restarts.items()):
+            if time.monotonic() >= due:
+                del restarts[i]
+                start(i)
+        if report_interval and time.monotonic() - last_report >= report_interval:
+            last_report = time.monotonic()
+            for child, usage in memory_report([os.getpid(), *children]).items():
+                print(f"  pid {child}: rss {usage['rss_mb']:.0f} MB, pss {usage['pss_mb']:.0f} MB")
+        time.sleep(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the advisor from several Streamlit workers sharing one model")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--base-port", type=int, default=8501, help="Port of the first worker")
+    parser.add_argument("--threads-per-worker", type=int, help="torch threads per worker (default: cores / workers)")
+    parser.add_argument("--memory-report", type=int, default=0, metavar="SECONDS",
+                        help="Print per-process RSS/PSS every SECONDS (0: off)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    supervise(args.workers, args.base_port, args.threads_per_worker, args.memory_report)
+
+
+if __name__ == "__main__":
+    main()
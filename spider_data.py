@@ -0,0 +1,237 @@
+"""
+Streaming loader and columnar cache for Spider-format JSON datasets.
+
+A Spider file is one large JSON array of objects. iter_json_array parses it
+incrementally, one item at a time, so neither detecting a file's format nor
+converting it needs the whole array in memory. The field mapping
+(question / db_id / SQL) is detected from the first item.
+
+open_dataset converts a file once into a columnar cache directory:
+
+    question.offsets.npy, question.bin      UTF-8 strings, concatenated
+    gold_query.offsets.npy, gold_query.bin
+    db_id.codes.npy                         index into manifest["db_ids"]
+    manifest.json                           source size/mtime, fields, row count
+
+Later runs memory-map the columns, so opening a dataset is instant and sampling or
+filtering by db_id never touches the raw JSON. The cache is rebuilt when the
+source file or the field mapping changes.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_DIR = "spider_cache"
+CACHE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+READ_SIZE = 1 << 20
+_DELIMITERS = " \t\r\n,]"
+STRING_COLUMNS = ("question", "gold_query")
+
+# candidate source field names for each column, in order of preference
+FIELD_CANDIDATES = {
+    "question": ("question", "utterance", "nl", "text"),
+    "db_id": ("db_id", "database", "db"),
+    "gold_query": ("query", "gold_query", "sql", "SQL"),
+}
+
+
+def iter_json_array(path, read_size=READ_SIZE):
+    """Yield the items of a top-level JSON array one by one without loading the whole file."""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = f.read(read_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} does not contain a JSON array")
+        position = 1
+        eof = False
+        while True:
+            # skip whitespace and separators between items
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n,":
+                    position += 1
+                if position < len(buffer) or eof:
+                    break
+                buffer, position = f.read(read_size), 0
+                eof = not buffer
+            if position >= len(buffer) or buffer[position] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                # an item is complete once it is followed by a separator: a number ending at
+                # or inside the block ("2." of "2.5") may continue in the next block
+                complete = eof or (end < len(buffer) and buffer[end] in _DELIMITERS)
+            except json.JSONDecodeError:
+                complete = False
+            if not complete:
+                more = f.read(read_size)
+                if not more:
+                    if eof:
+                        raise ValueError(f"{path} ends in the middle of a JSON item")
+                    eof = True
+                # the item continues in the next block
+                buffer, position = buffer[position:] + more, 0
+                continue
+            yield item
+            position = end
+
+
+def detect_fields(item):
+    """Map question/db_id/gold_query to the string fields of a sample item; None if it is not Spider-like."""
+    if not isinstance(item, dict):
+        return None
+    fields = {}
+    for column, candidates in FIELD_CANDIDATES.items():
+        field = next((name for name in candidates if isinstance(item.get(name), str)), None)
+        if field is None:
+            return None
+        fields[column] = field
+    return fields
+
+
+def peek_fields(path):
+    """Field mapping of a JSON file, read from its first item only."""
+    try:
+        return detect_fields(next(iter_json_array(path, read_size=64 * 1024), None))
+    except (OSError, ValueError):
+        return None
+
+
+def find_spider_files(directory):
+    """(file name, path, field mapping) of every Spider-format JSON file in a directory."""
+    found = []
+    for file in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file)
+        if file.endswith(".json") and os.path.isfile(path):
+            fields = peek_fields(path)
+            if fields is not None:
+                found.append((file, path, fields))
+    return found
+
+
+class SpiderDataset:
+    """Read-only view of a cached dataset; rows are decoded lazily from memory-mapped columns."""
+
+    def __init__(self, cache_path):
+        with open(os.path.join(cache_path, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.db_ids = self.manifest["db_ids"]
+        self._db_codes = np.load(os.path.join(cache_path, "db_id.codes.npy"), mmap_mode="r")
+        self._columns = {}
+        for column in STRING_COLUMNS:
+            offsets = np.load(os.path.join(cache_path, f"{column}.offsets.npy"), mmap_mode="r")
+            data_path = os.path.join(cache_path, f"{column}.bin")
+            data = np.memmap(data_path, dtype=np.uint8, mode="r") if offsets[-1] else np.zeros(0, dtype=np.uint8)
+            self._columns[column] = (offsets, data)
+
+    def __len__(self):
+        return len(self._db_codes)
+
+    def _string(self, column, index):
+        offsets, data = self._columns[column]
+        return bytes(data[offsets[index]:offsets[index + 1]]).decode("utf-8")
+
+    def __getitem__(self, index):
+        return {
+            "question": self._string("question", index),
+            "db_id": self.db_ids[self._db_codes[index]],
+            "gold_query": self._string("gold_query", index),
+        }
+
+    def indices(self, db_ids=None):
+        """Row indices, optionally only those whose db_id is in db_ids."""
+        if not db_ids:
+            return np.arange(len(self))
+        codes = [self.db_ids.index(db_id) for db_id in db_ids if db_id in self.db_ids]
+        return np.flatnonzero(np.isin(self._db_codes, codes))
+
+    def rows(self, indices=None):
+        if indices is None:
+            indices = range(len(self))
+        return [self[int(index)] for index in indices]
+
+    def sample(self, n=None, db_ids=None, seed=0):
+        """Rows for the given db_ids (all by default); a random sample of n of them if n is given."""
+        indices = self.indices(db_ids)
+        if n is not None and n < len(indices):
+            indices = np.sort(np.random.default_rng(seed).choice(indices, size=n, replace=False))
+        return self.rows(indices)
+
+
+def _cache_path(json_path, cache_dir):
+    key = hashlib.sha1(os.path.abspath(json_path).encode("utf-8")).hexdigest()[:10]
+    return os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(json_path))[0]}-{key}")
+
+
+def _source_info(json_path):
+    stat = os.stat(json_path)
+    return {"path": os.path.abspath(json_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def build_cache(json_path, cache_path, fields):
+    """Stream a Spider JSON file into the columnar cache at cache_path."""
+    os.makedirs(cache_path, exist_ok=True)
+    manifest_path = os.path.join(cache_path, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    offsets = {column: [0] for column in STRING_COLUMNS}
+    db_index = {}
+    codes = []
+    files = {column: open(os.path.join(cache_path, f"{column}.bin"), "wb") for column in STRING_COLUMNS}
+    try:
+        for item in iter_json_array(json_path):
+            for column in STRING_COLUMNS:
+                encoded = str(item.get(fields[column]) or "").encode("utf-8")
+                files[column].write(encoded)
+                offsets[column].append(offsets[column][-1] + len(encoded))
+            codes.append(db_index.setdefault(str(item.get(fields["db_id"]) or ""), len(db_index)))
+    finally:
+        for f in files.values():
+            f.close()
+
+    for column in STRING_COLUMNS:
+        np.save(os.path.join(cache_path, f"{column}.offsets.npy"), np.asarray(offsets[column], dtype=np.int64))
+    code_dtype = np.uint16 if len(db_index) < 2 ** 16 else np.uint32
+    np.save(os.path.join(cache_path, "db_id.codes.npy"), np.asarray(codes, dtype=code_dtype))
+
+    manifest = {
+        "version": CACHE_VERSION,
+        "source": _source_info(json_path),
+        "fields": fields,
+        "rows": len(codes),
+        "db_ids": list(db_index),
+    }
+    # the manifest is written last, so an interrupted build is never mistaken for a valid cache
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def _cache_is_current(cache_path, json_path, fields):
+    try:
+        with open(os.path.join(cache_path, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (manifest.get("version") == CACHE_VERSION
+            and manifest.get("source") == _source_info(json_path)
+            and (fields is None or manifest.get("fields") == fields))
+
+
+def open_dataset(json_path, fields=None, cache_dir=CACHE_DIR):
+    """
+    Open a Spider JSON file through its columnar cache, building the cache on first use.
+
+    fields maps question/db_id/gold_query to source field names; detected from the
+    first item when None.
+    """
+    cache_path = _cache_path(json_path, cache_dir)
+    if not _cache_is_current(cache_path, json_path, fields):
+        fields = fields or peek_fields(json_path)
+        if fields is None:
+            raise ValueError(f"Could not detect question/db_id/SQL fields in {json_path}")
+        build_cache(json_path, cache_path, fields)
+    return SpiderDataset(cache_path)
@@ -0,0 +1,246 @@
+"""
+Lightweight tracing and metrics for the advisor's request path.
+
+    with span("retrieval", k=3) as s:
+        docs = vector_store.similarity_search(question, k=3)
+        s.set(results=len(docs))
+
+Finished spans are aggregated into per-name duration histograms (served in the
+Prometheus text format) and, if a trace file is configured, appended to it as
+JSON lines with their parent span. Tracing is off unless ADVISOR_TRACING=1 or
+configure(enabled=True) is called; while off, span() returns a shared no-op
+object, so instrumented code pays only a function call and a flag check.
+
+Environment variables: ADVISOR_TRACING, ADVISOR_TRACE_FILE, ADVISOR_METRICS_PORT.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_enabled = False
+_trace_file = None
+_lock = threading.Lock()
+_local = threading.local()
+# name -> [count, sum, bucket counts, numeric attribute totals, last value of rate/latency attributes]
+_stats = {}
+GAUGE_SUFFIXES = ("_per_sec", "_ms")
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ("name", "attrs", "span_id", "parent_id", "start", "_wall")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent_id = stack[-1].span_id if stack else None
+        stack.append(self)
+        self._wall = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        stack = _local.stack
+        if stack and stack[-1] is self:
+            stack.pop()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        _record(self, duration)
+        return False
+
+
+def _record(span, duration):
+    with _lock:
+        stats = _stats.get(span.name)
+        if stats is None:
+            stats = _stats[span.name] = [0, 0.0, [0] * len(BUCKETS), {}, {}]
+        stats[0] += 1
+        stats[1] += duration
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                stats[2][i] += 1
+        for key, value in span.attrs.items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            if key.endswith(GAUGE_SUFFIXES):
+                stats[4][key] = value
+            else:
+                stats[3][key] = stats[3].get(key, 0) + value
+
+        if _trace_file is not None:
+            _trace_file.write(json.dumps({
+                "name": span.name,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "start": span._wall,
+                "duration_ms": duration * 1000,
+                "thread": threading.current_thread().name,
+                "attrs": span.attrs,
+            }, ensure_ascii=False, default=str) + "\n")
+
+
+def span(name, **attrs):
+    """Start a span; use as a context manager."""
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def traced(name=None):
+    """Decorator wrapping every call of a function in a span."""
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with Span(span_name, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+def is_enabled():
+    return _enabled
+
+
+def configure(enabled=True, trace_file=None, metrics_port=None):
+    """Turn tracing on/off, optionally writing spans to a JSONL file and serving /metrics."""
+    global _enabled, _trace_file
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.close()
+            _trace_file = None
+        if trace_file:
+            _trace_file = open(trace_file, "a", encoding="utf-8", buffering=1)
+        _enabled = enabled
+    if metrics_port:
+        start_metrics_server(int(metrics_port))
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def snapshot():
+    """Per-span count, total/mean seconds, summed counts and last rate/latency attributes."""
+    with _lock:
+        return {
+            name: {"count": count, "total_s": total, "mean_s": total / count if count else 0.0, **totals, **gauges}
+            for name, (count, total, _, totals, gauges) in _stats.items()
+        }
+
+
+def prometheus_text():
+    """Render the collected metrics in the Prometheus text exposition format."""
+    lines = [
+        "# HELP advisor_span_duration_seconds Duration of traced request stages.",
+        "# TYPE advisor_span_duration_seconds histogram",
+    ]
+    with _lock:
+        items = sorted((name, count, total, list(buckets), dict(totals), dict(gauges))
+                       for name, (count, total, buckets, totals, gauges) in _stats.items())
+    for name, count, total, buckets, _, _ in items:
+        for bound, value in zip(BUCKETS, buckets):
+            lines.append(f'advisor_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {value}')
+        lines.append(f'advisor_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {count}')
+        lines.append(f'advisor_span_duration_seconds_sum{{span="{name}"}} {total}')
+        lines.append(f'advisor_span_duration_seconds_count{{span="{name}"}} {count}')
+
+    lines.append("# HELP advisor_span_attribute_total Sum of numeric span attributes (tokens, documents, ...).")
+    lines.append("# TYPE advisor_span_attribute_total counter")
+    for name, _, _, _, totals, _ in items:
+        for key, value in sorted(totals.items()):
+            lines.append(f'advisor_span_attribute_total{{span="{name}",attribute="{key}"}} {value}')
+
+    lines.append("# HELP advisor_span_attribute_last Last observed rate/latency attribute (tokens_per_sec, ..._ms).")
+    lines.append("# TYPE advisor_span_attribute_last gauge")
+    for name, _, _, _, _, gauges in items:
+        for key, value in sorted(gauges.items()):
+            lines.append(f'advisor_span_attribute_last{{span="{name}",attribute="{key}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def reset_after_fork(metrics_port=None):
+    """
+    In a forked child: drop the parent's collected stats and metrics server (its thread
+    did not survive the fork) and serve this process's metrics on metrics_port instead.
+    """
+    global _server
+    with _lock:
+        _stats.clear()
+        if _server is not None:
+            # closes only this process's copy of the listening socket
+            _server.socket.close()
+            _server = None
+    if metrics_port:
+        start_metrics_server(int(metrics_port))
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serve prometheus_text() at http://host:port/metrics from a daemon thread (once per process)."""
+    global _server
+    with _lock:
+        if _server is not None:
+            return _server
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _server
+
+
+if os.environ.get("ADVISOR_TRACING", "0") == "1":
+    configure(True, os.environ.get("ADVISOR_TRACE_FILE"), os.environ.get("ADVISOR_METRICS_PORT"))
@@ -0,0 +1,209 @@
+"""
+Configurable FAISS index types and a sharded vector store.
+
+Index types (all L2, like the default langchain FAISS store):
+    flat   exact brute-force search over float32 vectors
+    sq8    scalar-quantized (1 byte per dimension), exact scan
+    ivfpq  inverted lists + product quantization; trained on the ingested vectors
+           (shards smaller than IVFPQ_MIN_VECTORS fall back to flat)
+    hnsw   graph-based approximate search over float32 vectors
+
+ShardedVectorStore keeps one store per shard (faculty, or the top-level folder of
+the document's source) and answers a query by searching every shard in parallel
+and merging the top-k.
+"""
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+from langchain_core.vectorstores import VectorStore
+
+INDEX_TYPES = ("flat", "sq8", "ivfpq", "hnsw")
+DEFAULT_SHARD = "default"
+
+# IVF-PQ settings; nlist is reduced automatically for small corpora
+IVF_NLIST = 256
+IVF_NPROBE = 16
+PQ_M = 48
+PQ_NBITS = 8
+# 8-bit PQ has 256 centroids per sub-quantizer and faiss wants ~39 training points per
+# centroid; below this many vectors a flat index is used
+IVFPQ_MIN_VECTORS = 39 * 2 ** PQ_NBITS
+# trained index types are trained on (at most) the first TRAIN_VECTORS vectors of a shard
+TRAIN_VECTORS = 65536
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+
+
+def make_index(dim, index_type, num_vectors):
+    """Create an empty (untrained) FAISS index of the given type."""
+    faiss = dependable_faiss_import()
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    if index_type == "ivfpq":
+        if num_vectors < IVFPQ_MIN_VECTORS:
+            return faiss.IndexFlatL2(dim)
+        # faiss wants ~39 training points per centroid
+        nlist = max(1, min(IVF_NLIST, num_vectors // 39))
+        m = PQ_M if dim % PQ_M == 0 else next(d for d in range(min(PQ_M, dim), 0, -1) if dim % d == 0)
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, m, PQ_NBITS)
+        index.nprobe = min(IVF_NPROBE, nlist)
+        return index
+    raise ValueError(f"Unknown index type: {index_type} (expected one of {', '.join(INDEX_TYPES)})")
+
+
+def build_store_from_batches(batches, embeddings, index_type="flat", num_vectors=0):
+    """
+    Build a langchain FAISS store from (docs, ids, vectors) batches.
+
+    Vectors are added to the index batch by batch; for trained index types only the
+    first TRAIN_VECTORS vectors are buffered to train it. num_vectors is the total
+    number of vectors, which selects the IVF-PQ parameters.
+    """
+    index = None
+    training = []
+    docstore = {}
+    index_to_docstore_id = {}
+    for docs, ids, vectors in batches:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if index is None:
+            index = make_index(vectors.shape[1], index_type, num_vectors or len(vectors))
+        for doc_id, doc in zip(ids, docs):
+            index_to_docstore_id[len(docstore)] = doc_id
+            docstore[doc_id] = doc
+        if index.is_trained:
+            index.add(vectors)
+            continue
+        training.append(vectors)
+        if sum(len(part) for part in training) >= TRAIN_VECTORS:
+            training = _train_and_add(index, training)
+    if training:
+        _train_and_add(index, training)
+    return FAISS(embeddings, index, InMemoryDocstore(docstore), index_to_docstore_id)
+
+
+def _train_and_add(index, parts):
+    vectors = np.concatenate(parts)
+    index.train(vectors[:TRAIN_VECTORS])
+    index.add(vectors)
+    return []
+
+
+def shard_key(doc, shard_by):
+    """Shard of a chunk: its metadata[shard_by] if set, else the top-level folder of its source."""
+    if not shard_by:
+        return DEFAULT_SHARD
+    value = doc.metadata.get(shard_by)
+    if not value:
+        parts = os.path.normpath(doc.metadata.get("source", "")).split(os.sep)
+        value = parts[0] if len(parts) > 1 else DEFAULT_SHARD
+    # used as a directory name on disk
+    return re.sub(r"[^\w\-.]", "_", str(value))
+
+
+class ShardedVectorStore(VectorStore):
+    """Vector store fanning each query out to per-shard FAISS stores and merging the top-k."""
+
+    def __init__(self, shards, embeddings, max_workers=None):
+        self.shards = shards
+        self._embeddings = embeddings
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or max(1, len(shards)))
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    def close(self):
+        """Stop the search threads (resources.evict calls this)."""
+        self._executor.shutdown(wait=False)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, shards=None, **kwargs):
+        names = shards or list(self.shards)
+        futures = [
+            self._executor.submit(self.shards[name].similarity_search_with_score_by_vector, embedding, k, **kwargs)
+            for name in names if name in self.shards
+        ]
+        results = [pair for future in futures for pair in future.result()]
+        # L2 distance: smaller is closer
+        results.sort(key=lambda pair: pair[1])
+        return results[:k]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        embedding = self._embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        return self._euclidean_relevance_score_fn
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("Sharded stores are rebuilt by knowledge_base.load_vector_store")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Use knowledge_base.load_vector_store(shard_by=...)")
+
+
+def recall_report(texts, embeddings, queries, index_types=INDEX_TYPES, k=10):
+    """
+    Recall@k and query latency of each index type against exact flat search.
+
+    texts are the indexed chunks and queries the query strings; both are embedded
+    once with `embeddings`, so results reflect the real data distribution. ivfpq is
+    skipped (reported with a "skipped" reason) below IVFPQ_MIN_VECTORS texts, where
+    make_index would return a flat index.
+    """
+    faiss = dependable_faiss_import()
+    vectors = np.asarray(embeddings.embed_documents(list(texts)), dtype=np.float32)
+    query_vectors = np.asarray(embeddings.embed_documents(list(queries)), dtype=np.float32)
+    k = min(k, len(vectors))
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(query_vectors, k)
+
+    report = {}
+    for index_type in index_types:
+        if index_type == "ivfpq" and len(vectors) < IVFPQ_MIN_VECTORS:
+            report[index_type] = {"skipped": f"{len(vectors)} vectors, ivfpq needs at least {IVFPQ_MIN_VECTORS}"}
+            continue
+        index = make_index(vectors.shape[1], index_type, len(vectors))
+        started = time.perf_counter()
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        build_s = time.perf_counter() - started
+
+        latencies = []
+        found = np.empty_like(truth)
+        for i, query in enumerate(query_vectors):
+            started = time.perf_counter()
+            _, ids = index.search(query[None, :], k)
+            latencies.append(time.perf_counter() - started)
+            found[i] = ids[0]
+
+        recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+        report[index_type] = {
+            "recall_at_k": float(recall),
+            "p50_query_ms": float(np.percentile(latencies, 50) * 1000),
+            "p95_query_ms": float(np.percentile(latencies, 95) * 1000),
+            "build_s": build_s,
+            "bytes_per_vector": len(faiss.serialize_index(index)) / len(vectors),
+        }
+    return report